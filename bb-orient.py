@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# bb-orient - align head/tail orientation of the backbones of a whole
+# recording
+#
+# Usage: bb-orient.py [-n] [-r REFFRAME] BACKBONEPATTERN FIRST-LAST
+#
+# BACKBONEPATTERN is a backbone filename with %d in place of the frame
+# number, as in extract-traces.py; frames without a backbone file are
+# skipped.
+#
+# All the backbones are resampled to BB_POINTS points along their arc
+# length and each is compared with the previous one, both as it is and
+# reversed, by the distances of their endpoints and of the whole shapes;
+# it is flipped relative to the previous one if the reversed one is
+# closer. The orientation of REFFRAME (the first frame by default) is
+# kept and the files of frames whose orientation differs from it are
+# rewritten reversed, in their original format. This replaces running
+# bb-reverse.py on hand-picked files.
+#
+# The flipped frame numbers are printed on stdout; with -n, the files
+# are left untouched. Comparisons that are nearly a tie (e.g. for a
+# coiled worm) are reported on stderr, since a wrong decision there
+# flips all the frames that follow.
+
+import argparse
+import sys
+
+import numpy
+
+import poselib
+
+
+# Number of points backbones are compared at
+BB_POINTS = 32
+# Comparisons whose same and reversed distances differ by less than
+# this fraction of their sum are reported as ambiguous
+AMBIGUOUS_MARGIN = 0.1
+
+
+def loadBackbones(bbpattern, frames):
+    """
+    Load backbones of @frames named by @bbpattern. Return a tuple
+    (frames, backbones, resampled) with the numbers of frames that
+    have a backbone, their (points, edgedists) tuples and an array
+    of their [y, x] points resampled to BB_POINTS points.
+    """
+    found = []
+    backbones = []
+    for frameNo in frames:
+        try:
+            backbones.append(poselib.bbLoad(bbpattern % frameNo))
+        except IOError:
+            continue
+        found.append(frameNo)
+    resampled = numpy.array([poselib.bbResample([[p[1], p[2]] for p in points], BB_POINTS)
+                             for (points, edgedists) in backbones])
+    return (found, backbones, resampled)
+
+def flipLinks(resampled):
+    """
+    Compare each of @resampled backbones with the previous one. Return
+    a tuple (flips, margins) of arrays telling for each consecutive pair
+    whether the latter is reversed relative to the former, and by what
+    relative margin the decision was made.
+    """
+    prev = resampled[:-1]
+    cur = resampled[1:]
+    rev = cur[:, ::-1]
+    pointdist = lambda a, b: numpy.sqrt(((a - b) ** 2).sum(axis = -1))
+
+    same = pointdist(prev, cur).mean(axis = 1) + pointdist(prev[:, [0, -1]], cur[:, [0, -1]]).mean(axis = 1)
+    flipped = pointdist(prev, rev).mean(axis = 1) + pointdist(prev[:, [0, -1]], rev[:, [0, -1]]).mean(axis = 1)
+    margins = numpy.abs(same - flipped) / numpy.maximum(same + flipped, 1e-9)
+    return (flipped < same, margins)
+
+def orientations(flips, refindex):
+    """
+    Return a boolean array telling for each backbone whether it is
+    reversed relative to backbone @refindex, given the pairwise @flips.
+    """
+    parity = numpy.concatenate([[0], numpy.cumsum(flips)]) % 2
+    return parity != parity[refindex]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog = 'bb-orient.py')
+    parser.add_argument('-n', '--dry-run', action = 'store_true')
+    parser.add_argument('-r', '--reference', type = int, default = None)
+    parser.add_argument('bbpattern')
+    parser.add_argument('frames')
+    args = parser.parse_args(argv)
+
+    (first, last) = [int(f) for f in args.frames.split('-')]
+    (frames, backbones, resampled) = loadBackbones(args.bbpattern, range(first, last + 1))
+    if not frames:
+        print >>sys.stderr, "No backbones found"
+        return 1
+
+    if args.reference is None:
+        refindex = 0
+    elif args.reference in frames:
+        refindex = frames.index(args.reference)
+    else:
+        parser.error('no backbone of reference frame %d' % args.reference)
+
+    (flips, margins) = flipLinks(resampled)
+    for i in numpy.nonzero(margins < AMBIGUOUS_MARGIN)[0]:
+        print >>sys.stderr, "Ambiguous orientation of frame %d relative to frame %d (margin %.3f)" \
+                % (frames[i + 1], frames[i], margins[i])
+
+    for i in numpy.nonzero(orientations(flips, refindex))[0]:
+        print frames[i]
+        if not args.dry_run:
+            (points, edgedists) = backbones[i]
+            poselib.bbSave(args.bbpattern % frames[i], points[::-1], edgedists[::-1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,19 +5,21 @@
 # Load backbone and print it to the stdout (as TSV) reversed.
 #
 # Example: for i in *backbone*.json; do ./bb-reverse.py $i >$i.tsv; ./tsv2json.sh $i.tsv >$i; done
+#
+# To detect and fix reversed backbones of a whole recording at once,
+# see bb-orient.py.
 
 import poselib
 import numpy
 import sys
 
 
-def printTSV(backbone, edgedists):
-    for i in range(len(backbone)):
-        point = backbone[i]
-        print point[0], point[1], point[2], edgedists[i]
-
-if __name__ == '__main__':
-    filename = sys.argv[1]
+def main(argv):
+    filename = argv[0]
 
     (points, edgedists) = poselib.bbLoad(filename)
-    printTSV(points[::-1], edgedists[::-1])
+    poselib.bbWriteTSV(sys.stdout, points[::-1], edgedists[::-1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
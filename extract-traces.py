@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# extract-traces - extract fluorescence time series of NeuroML neurons
+# interposed on the frames of a whole recording
+#
+# Usage: extract-traces.py [-j JOBS] [-f FIRST-LAST] HDF5FILE BACKBONEPATTERN POSEINFO NEUROML2DIR OUTPUTFILE
+#
+# BACKBONEPATTERN is a backbone filename with %d in place of the frame
+# number, e.g. "bb/%d-backbone.json"; frames without a backbone file
+# are skipped.
+#
+# POSEINFO and NEUROML2DIR are as in interpose-neuroml.py.
+#
+# For each frame (only FIRST to LAST inclusive, if given), all neurons
+# are projected to the frame by its backbone and the uvframe intensity
+# is integrated over each projected soma disc. The frames are processed
+# in JOBS parallel worker processes (all cpus by default).
+#
+# OUTPUTFILE is a HDF5 file with the /traces (frames x neurons) float
+# matrix, with NaN for neurons not (fully) within the frame, and /frames
+# and /neurons arrays with the frame numbers and neuron names.
+#
+# Projected neurons and traces of each frame are kept in the result
+# store (see storelib.py); a re-run computes only the frames whose
+# uvframe, backbone, neurons or pose info have changed.
+
+import argparse
+import multiprocessing
+import sys
+
+import numpy
+import tables
+
+import nmllib
+import poselib
+import rasterlib
+import storelib
+import uvcachelib
+
+
+# Soma discs are integrated at this scale of the NeuroML diameter,
+# the same as interpose-neuroml.py draws them with.
+SOMA_RADIUS_SCALE = 1 / 10.
+
+
+def frameTraces(filename, frameNo, bbfilename, neurons, stencils, poseinfo, neuronskey):
+    """
+    Return an array of @neurons intensities in frame @frameNo, integrated
+    over their @stencils projected by backbone @bbfilename and @poseinfo.
+    """
+    h5file = uvcachelib.open_h5file(filename)
+    uvframe = uvcachelib.load_uvframe(h5file, frameNo)
+    proj = poselib.bbProjNeurons(bbfilename, neurons, poseinfo, neuronskey)
+    centers = [None if numpy.isnan(c[0]) else c for c in proj["centers"]]
+    return rasterlib.stencilSums(uvframe, centers, stencils)
+
+def tracesKey(h5file, frameNo, bbfilename, poseinfo, neuronskey):
+    """
+    Return the result store key of traces of frame @frameNo.
+    """
+    params = {"poseinfo": poseinfo, "radius_scale": SOMA_RADIUS_SCALE}
+    inputs = [uvcachelib.uvframe_key(h5file, frameNo), storelib.file_digest(bbfilename), neuronskey]
+    return storelib.result_key('traces', params, inputs)
+
+# Per-process job parameters, set by _initWorker()
+_job = None
+
+def _initWorker(job):
+    global _job
+    _job = job
+
+def _frameTraces(task):
+    (frameNo, key) = task
+    row = frameTraces(_job["filename"], frameNo, _job["bbpattern"] % frameNo, _job["neurons"],
+                      _job["stencils"], _job["poseinfo"], _job["neuronskey"])
+    storelib.store_put(key, {"row": row})
+    return (row, storelib.take_stats())
+
+def extractTraces(filename, frames, bbpattern, neurons, poseinfo, jobs):
+    """
+    Yield trace rows of @neurons for each of @frames in order, computed
+    in @jobs worker processes unless already stored. A row is None if
+    the frame was skipped.
+    """
+    stencil = rasterlib.stencilCache()
+    stencils = [stencil(poselib.projDiameter(n["diameter"], poseinfo) / 2. * SOMA_RADIUS_SCALE)
+                for n in neurons]
+    neuronskey = storelib.text_digest(nmllib.jsondump_neurons(neurons))
+    job = {"filename": filename, "bbpattern": bbpattern, "neurons": neurons,
+           "stencils": stencils, "poseinfo": poseinfo, "neuronskey": neuronskey}
+
+    # Look up the stored rows first, so that only the missing ones
+    # are computed
+    h5file = uvcachelib.open_h5file(filename)
+    rows = []
+    tasks = []
+    for frameNo in frames:
+        try:
+            key = tracesKey(h5file, frameNo, bbpattern % frameNo, poseinfo, neuronskey)
+        except IOError as e:
+            sys.stderr.write("Skipping frame %d: %s\n" % (frameNo, e))
+            rows.append(None)
+            continue
+        result = storelib.store_get(key)
+        storelib.record('traces', result is not None)
+        if result is not None:
+            rows.append(result["row"])
+        else:
+            # Placeholder for the row computed below
+            rows.append(key)
+            tasks.append((frameNo, key))
+
+    if jobs <= 1:
+        _initWorker(job)
+        computed = (_frameTraces(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, _initWorker, (job,))
+        # imap() hands over the rows in order as they are ready; it does
+        # not stop the workers from running ahead, so finished rows may
+        # pile up here, which is fine only because the rows are small
+        computed = pool.imap(_frameTraces, tasks)
+    try:
+        for row in rows:
+            if isinstance(row, str):
+                (row, stats) = next(computed)
+                storelib.merge_stats(stats)
+            yield row
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def writeTraces(outputfile, frames, neurons, rows):
+    """
+    Write trace @rows of @neurons for @frames to HDF5 @outputfile.
+    """
+    out = tables.open_file(outputfile, mode = "w")
+    try:
+        out.create_array('/', 'frames', numpy.array(frames))
+        out.create_array('/', 'neurons', numpy.array([str(n["name"]) for n in neurons]))
+        traces = out.create_carray('/', 'traces', tables.Float32Atom(dflt = numpy.nan),
+                                   shape = (len(frames), len(neurons)))
+        for (i, row) in enumerate(rows):
+            if row is not None:
+                traces[i] = row
+    finally:
+        out.close()
+
+def mergeShards(outputfile, shardfiles):
+    """
+    Merge trace files @shardfiles of separate frame ranges (see the shard
+    mode of sigextract.py) into a single @outputfile.
+    """
+    frames = []
+    rows = []
+    names = None
+    for shardfile in shardfiles:
+        f = tables.open_file(shardfile, mode = "r")
+        try:
+            shardnames = f.root.neurons.read().tolist()
+            if names is None:
+                names = shardnames
+            elif shardnames != names:
+                raise ValueError('%s: neurons differ from the other shards' % shardfile)
+            frames.extend(f.root.frames.read().tolist())
+            rows.extend(f.root.traces.read())
+        finally:
+            f.close()
+    order = sorted(range(len(frames)), key = lambda i: frames[i])
+    writeTraces(outputfile, [frames[i] for i in order], [{"name": name} for name in names],
+                [rows[i] for i in order])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog = 'extract-traces.py')
+    parser.add_argument('-j', '--jobs', type = int, default = multiprocessing.cpu_count())
+    parser.add_argument('-f', '--frames', default = None)
+    parser.add_argument('filename')
+    parser.add_argument('bbpattern')
+    parser.add_argument('poseinfo')
+    parser.add_argument('nmdir')
+    parser.add_argument('outputfile')
+    args = parser.parse_args(argv)
+
+    poseinfo = dict(zip(["zoom", "shift", "angle"], [float(f) for f in args.poseinfo.split(',')]))
+    neurons = nmllib.load_neurons(args.nmdir)
+
+    frames = uvcachelib.list_frames(uvcachelib.open_h5file(args.filename))
+    if args.frames:
+        (first, last) = [int(f) for f in args.frames.split('-')]
+        frames = [f for f in frames if first <= f <= last]
+
+    rows = extractTraces(args.filename, frames, args.bbpattern, neurons, poseinfo, args.jobs)
+    writeTraces(args.outputfile, frames, neurons, rows)
+    storelib.report()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
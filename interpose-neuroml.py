@@ -25,11 +25,10 @@
 
 import math
 import sys
-import tables
 
 import numpy
-import hdf5lflib
 import poselib
+import uvcachelib
 import nmllib
 
 import matplotlib.pyplot as plt
@@ -49,10 +48,10 @@ def draw_uvframe_neurons(uvframe, bbpoints, neurons, poseinfo, title):
             edgecolor = 'yellow', fill = 0))
 
     for n in neurons:
-        pos = poselib.projTranslateByBb(poselib.projCoord(n["pos"], poseinfo), bbpoints, n["name"], poseinfo)
-        if pos is None:
+        proj = poselib.projNeuron(n, bbpoints, poseinfo)
+        if proj is None:
             continue
-        r = poselib.projDiameter(n["diameter"], poseinfo) / 2.
+        (pos, r) = proj
         print "showing", n["name"], "pos", pos, "r", r
         ax.add_patch(matplotlib.patches.Circle(pos, radius = r / 10.,
             edgecolor = 'green', fill = 0))
@@ -61,23 +60,17 @@ def draw_uvframe_neurons(uvframe, bbpoints, neurons, poseinfo, title):
     plt.show()
 
 
-if __name__ == '__main__':
-    filename = sys.argv[1]
-    frameNo = int(sys.argv[2])
-    bbfilename = sys.argv[3]
-    poseinfo_str = sys.argv[4]
+def main(argv):
+    filename = argv[0]
+    frameNo = int(argv[1])
+    bbfilename = argv[2]
+    poseinfo_str = argv[3]
     poseinfo = dict(zip(["zoom", "shift", "angle"], [float(f) for f in poseinfo_str.split(',')]))
-    nmdir = sys.argv[5]
+    nmdir = argv[4]
 
     # Load the image uvframe
-    h5file = tables.open_file(filename, mode = "r")
-    node = h5file.get_node('/', '/images/' + str(frameNo))
-    ar = h5file.get_node('/', '/autorectification')
-    try:
-        cw = h5file.get_node('/', '/cropwindow')
-    except tables.NoSuchNodeError:
-        cw = None
-    uvframe = hdf5lflib.compute_uvframe(node, ar, cw)
+    h5file = uvcachelib.open_h5file(filename)
+    uvframe = uvcachelib.load_uvframe(h5file, frameNo)
 
     # Load the backbone spline
     (points, edgedists) = poselib.bbLoad(bbfilename)
@@ -88,3 +81,7 @@ if __name__ == '__main__':
     neurons = nmllib.load_neurons(nmdir)
 
     draw_uvframe_neurons(uvframe, bbpoints, neurons, poseinfo, poseinfo_str)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
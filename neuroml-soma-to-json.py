@@ -16,7 +16,11 @@ import sys
 
 
 
-if __name__ == '__main__':
-    nmdir = sys.argv[1]
+def main(argv):
+    nmdir = argv[0]
     neurons = nmllib.load_neurons(nmdir)
     print nmllib.jsondump_neurons(neurons)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,11 +5,15 @@ from __future__ import print_function
 import glob
 import json
 import numpy
+import os
 import sys
 
 import neuroml
 import neuroml.loaders as loaders
 
+# Loaded neurons, kept across calls (e.g. by the sigextract.py worker)
+_neurons = {}
+
 def load_neurons_json(nmfile):
     f = open(nmfile, 'r')
     data = json.load(f)
@@ -47,11 +51,39 @@ def load_neurons_from_dir(nmdir):
     return neurons
 
 
+def neurons_identity(nmloc):
+    """
+    Return a value identifying the current contents of a JSON file or
+    a NeuroML2 directory @nmloc. For a directory, the names, sizes and
+    mtimes of the NeuroML files within are used, as editing a file in
+    place does not change the mtime of the directory.
+    """
+    if nmloc.endswith('.json'):
+        filenames = [nmloc]
+    else:
+        filenames = sorted(glob.glob(nmloc + '/*.nml'))
+    identity = []
+    for filename in filenames:
+        st = os.stat(filename)
+        identity.append((filename, st.st_size, st.st_mtime))
+    return identity
+
 def load_neurons(nmloc):
+    """
+    Load neurons from a JSON file or a NeuroML2 directory @nmloc.
+    Repeated calls return the same (shared) list while @nmloc is not
+    modified.
+    """
+    identity = neurons_identity(nmloc)
+    cached = _neurons.get(nmloc)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
     if nmloc.endswith('.json'):
-        return load_neurons_json(nmloc)
+        neurons = load_neurons_json(nmloc)
     else:
-        return load_neurons_from_dir(nmloc)
+        neurons = load_neurons_from_dir(nmloc)
+    _neurons[nmloc] = (identity, neurons)
+    return neurons
 
 
 def jsondump_neurons(neurons):
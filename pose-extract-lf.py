@@ -3,11 +3,58 @@
 # Extract pose information from a c. elegans lightfield image
 # (assuming [0,0] - i.e. frontal - viewpoint).
 #
-# Usage: pose-extract.py HDF5FILE FRAMENUMBER
+# Usage: pose-extract.py [-s SEED] [-k RESTARTS] [-r RETRIES] [-l LENGTH]
+#                        [-q SCOREFILE] HDF5FILE FRAMENUMBER
+#        pose-extract.py [...] [-K KEYFRAMES] [-d MAXDIFF]
+#                        -o OUTPATTERN HDF5FILE FIRST-LAST
+#        pose-extract.py -M [...]
+#        pose-extract.py -b [...] -o OUTPATTERN HDF5FILE FRAMENUMBER|FIRST-LAST
+#
+# SEED initializes the random generator used for sampling the control
+# points, making the output reproducible (0 by default). If RESTARTS
+# is more than 1, that many independent samplings (with seeds derived
+# from SEED) run in parallel worker processes and the backbone with
+# the best quality score is picked.
+#
+# Each backbone is scored (see backboneScore()) to detect failed
+# extractions; the score is written as JSON to SCOREFILE if given.
+# A failed frame is re-extracted with a fresh seed up to RETRIES times;
+# if it still fails, the backbone is output anyway but the exit status
+# is 2, letting batch runs skip the frame. LENGTH is the expected
+# backbone length (e.g. of the neighbouring frames) to compare with.
 #
 # Output: A TSV-formatted file with pose control point coordinates
 # is printed on stdout: one line per point with the coordinates
-# in order "z y x".
+# in order "z y x" and the edge distance.
+#
+# In the batch mode, frames FIRST to LAST are processed, writing the
+# output to OUTPATTERN (and scores to SCOREFILE) with %d replaced by the
+# frame number. The full extraction runs only every KEYFRAMES frames
+# (1 by default, i.e. for all frames) and on frames whose blob differs
+# from the last keyframe by more than MAXDIFF fraction of the worm area;
+# backbones in between are interpolated from the neighbouring keyframes
+# and extracted only if the interpolation does not fit the worm.
+#
+# Extracted backbones are kept in the result store (see storelib.py)
+# and reused when the same frame is processed with the same parameters.
+#
+# With -b, each separate blob of the frame (e.g. several worms in view)
+# of at least MIN_BLOB_AREA pixels gets its own backbone, extracted
+# in parallel worker processes. OUTPATTERN (and SCOREFILE) then take
+# two %d placeholders, for the frame number and the blob id. A blob
+# keeps its id across frames as long as its backbone centroid moves
+# less than MAX_BLOB_SHIFT pixels from one frame to the next; other
+# blobs get new ids (see matchBlobs()). The ids are only consistent
+# within a single run, so a recording split into several runs (e.g. the
+# shard mode of sigextract.py, which refuses -b) would number the blobs
+# of each part anew. A frame without any blob counts as failed.
+# Keyframe interpolation is not available in this mode.
+#
+# With -M, the low-memory mode is used: the blob mask is computed in
+# place of the uvframe and the edge distances are kept in compact types
+# (see computeEdgeDistancesCompact()), so that more extractions can run
+# side by side on large frames. The peak memory use of the process and
+# its workers is reported on stderr at the end.
 
 # Our algorithm is:
 # 1. Convert the original image to a "blob mask" with the body of the
@@ -38,14 +85,21 @@
 #    of the worm, to provide a frame of reference for further work with
 #    the body of the worm.
 
+import argparse
+import json
 import math
+import multiprocessing
 import random
+import resource
 
 import numpy
 import numpy.ma as ma
 import scipy.ndimage as ndimage
 import scipy.ndimage.morphology
-import hdf5lflib
+import poselib
+import samplelib
+import storelib
+import uvcachelib
 
 import networkx as nx
 
@@ -58,10 +112,11 @@ from matplotlib.path import Path
 #various file processing/OS things
 import os
 import sys
-import tables
 
 
 PROGRESS_FIGURES = False
+# Use the low-memory variants of frameMask() and computeEdgeDistances()
+LOW_MEMORY = False
 NUM_SAMPLES = 160
 # Minimum distance between path control points; if two control
 # points are nearer than this to each other, that is fixed during filtering.
@@ -74,6 +129,42 @@ MIN_POINT_DISTANCE = 4.
 # prevent connections between separate blobs.
 LINE_VALUE_THRESHOLD = 0.9
 
+# Backbone failure detection thresholds (see backboneScore()).
+# Maximum fraction of control points discarded during extraction.
+MAX_DISCARDED_FRACTION = 0.5
+# Control points nearer than this to the edge are considered to be
+# off the worm body; at most MAX_OFFWORM_FRACTION of (non-tip) control
+# points may be off the worm.
+MIN_EDGE_DISTANCE = 1.
+MAX_OFFWORM_FRACTION = 0.1
+# Maximum turning angle (in degrees) between successive backbone
+# segments; there may be at most MAX_CURVATURE_SPIKES sharper turns.
+MAX_TURN_ANGLE = 90.
+MAX_CURVATURE_SPIKES = 1
+# Maximum ratio of the longest to the median backbone segment; longer
+# segments usually mean a jump between separate blobs.
+MAX_STEP_RATIO = 4.
+# Maximum relative deviation from the expected backbone length.
+MAX_LENGTH_DEVIATION = 0.25
+
+# In the multi-blob mode, blobs smaller than this (in pixels) are
+# considered debris and skipped; the others are extracted from crops
+# with this margin (in pixels) around the blob.
+MIN_BLOB_AREA = 200
+BLOB_MARGIN = 2
+# Maximum shift (in pixels) of a blob backbone centroid between frames
+# for the blob to keep its id.
+MAX_BLOB_SHIFT = 20.
+
+# Revision of the extraction algorithm, bumped when its results change
+EXTRACTION_REVISION = 2
+
+# Settings the extracted backbones depend on, to tell apart stored results
+EXTRACTION_SETTINGS = ['EXTRACTION_REVISION', 'NUM_SAMPLES', 'MIN_POINT_DISTANCE', 'LINE_VALUE_THRESHOLD',
+    'MAX_DISCARDED_FRACTION', 'MIN_EDGE_DISTANCE', 'MAX_OFFWORM_FRACTION',
+    'MAX_TURN_ANGLE', 'MAX_CURVATURE_SPIKES', 'MAX_STEP_RATIO', 'MAX_LENGTH_DEVIATION',
+    'MIN_BLOB_AREA', 'BLOB_MARGIN', 'LOW_MEMORY']
+
 
 def print_mask(mask):
     """
@@ -136,7 +227,7 @@ def computeEdgeDistances(uvframe):
     # edgedists is a masked array, with only already computed values unmasked;
     # at first, uvframe == 0 already are computed (as zeros)
     edgedists = ma.array(numpy.zeros(uvframe.shape, dtype = numpy.float), mask = (uvframe > 0))
-    edgedirs = ma.array(numpy.zeros(uvframe.shape, dtype = (numpy.float, 2)), mask = [[[j,j] for j in i] for i in uvframe > 0])
+    edgedirs = ma.array(numpy.zeros(uvframe.shape, dtype = (numpy.float, 2)), mask = numpy.dstack([uvframe > 0] * 2))
     #numpy.set_printoptions(threshold=numpy.nan)
     #print edgedists
     #print edgedirs
@@ -169,12 +260,63 @@ def computeEdgeDistances(uvframe):
 
     return (edgedists.data, edgedirs.data)
 
-def sampleRandomPoint(uvframe):
+def computeEdgeDistancesCompact(uvframe):
     """
-    Return a coordinate tuple of a random point with non-zero value in uvframe.
+    A low-memory variant of computeEdgeDistances(), returning float32
+    @edgedists and int16 @edgedirs and keeping track of the computed
+    pixels in a boolean mask instead of masked arrays.
+
+    The floodfill updates the whole frontier at once, each pixel taking
+    the nearest of its neighbors computed in the previous iterations,
+    so a few distances may come out slightly longer than those from
+    computeEdgeDistances().
+    """
+    todo = uvframe > 0
+    done = numpy.invert(todo)
+    edgedists = numpy.zeros(uvframe.shape, dtype = numpy.float32)
+    edgedirs = numpy.zeros(uvframe.shape + (2,), dtype = numpy.int16)
+
+    flood_spread = scipy.ndimage.morphology.generate_binary_structure(2, 2)
+    s2 = math.sqrt(2)
+    neighbor_ofs = numpy.array([[-1,-1],[-1,0],[-1,1], [0,-1],[0,1], [1,-1],[1,0],[1,1]])
+    neighbor_dist = [s2,1,s2, 1,1, s2,1,s2]
+
+    while todo.any():
+        (fy, fx) = numpy.nonzero(todo & scipy.ndimage.binary_dilation(done, flood_spread))
+        if len(fy) == 0:
+            # No edge to spread from
+            break
+
+        best = numpy.empty(len(fy), dtype = numpy.float32)
+        best.fill(numpy.inf)
+        nearestnei = numpy.zeros(len(fy), dtype = int)
+        for (k, (ofs, dist)) in enumerate(zip(neighbor_ofs, neighbor_dist)):
+            ny = fy + ofs[0]
+            nx = fx + ofs[1]
+            within = numpy.nonzero((ny >= 0) & (nx >= 0) & (ny < uvframe.shape[0]) & (nx < uvframe.shape[1]))[0]
+            within = within[done[ny[within], nx[within]]]
+            neighbor_val = edgedists[ny[within], nx[within]] + dist
+            # Strict comparison picks the first of equal neighbors,
+            # like ma.argmin() in computeEdgeDistances()
+            nearer = neighbor_val < best[within]
+            best[within[nearer]] = neighbor_val[nearer]
+            nearestnei[within[nearer]] = k
+
+        ofs = neighbor_ofs[nearestnei]
+        edgedists[fy, fx] = best
+        edgedirs[fy, fx] = edgedirs[fy + ofs[:, 0], fx + ofs[:, 1]] + ofs
+        done[fy, fx] = True
+        todo[fy, fx] = False
+
+    return (edgedists, edgedirs)
+
+def sampleRandomPoint(uvframe, rng):
+    """
+    Return a coordinate tuple of a random point with non-zero value in uvframe,
+    drawn using the random.Random instance @rng.
     """
     while True:
-        c = (random.randint(0, uvframe.shape[0]-1), random.randint(0, uvframe.shape[1]-1))
+        c = (rng.randint(0, uvframe.shape[0]-1), rng.randint(0, uvframe.shape[1]-1))
         if uvframe[c] > 0:
             return c
 
@@ -210,16 +352,18 @@ def lineSumValue(point0, point1, uvframe):
     return value
 
 def pointsDeduplicate(points):
-    # Filter out duplicate points
+    # Filter out duplicate points, looking up earlier occurences
+    # in a hash set. A tuple never equals a list, hence the type
+    # is a part of the key.
+    seen = set()
     for i in range(len(points)):
         if points[i] is None:
             continue
-        for j in range(i+1, len(points)):
-            if points[j] is None:
-                continue
-            if points[i] == points[j]:
-                points[j] = None
-                continue
+        key = (isinstance(points[i], tuple), tuple(points[i]))
+        if key in seen:
+            points[i] = None
+        else:
+            seen.add(key)
     return points
 
 
@@ -266,18 +410,10 @@ def pointsToBackbone(points, uvframe):
 
 def edgedistsInterpolate(edgedists, point):
     """
-    2x2 interpolation of distance for non-integer point coordinates.
+    2x2 interpolation of distance for non-integer point coordinates;
+    None if the point is outside of the picture.
     """
-    beta_y = math.ceil(point[0]) - point[0]
-    beta_x = math.ceil(point[1]) - point[1]
-    try:
-        curdist = (beta_y * beta_x * edgedists[math.floor(point[0]), math.floor(point[1])]
-                   + beta_y * (1.-beta_x) * edgedists[math.floor(point[0]), math.ceil(point[1])]
-                   + (1.-beta_y) * beta_x * edgedists[math.ceil(point[0]), math.floor(point[1])]
-                   + (1.-beta_y) * (1.-beta_x) * edgedists[math.ceil(point[0]), math.ceil(point[1])]) / 4.
-    except IndexError:
-        return None
-    return curdist
+    return samplelib.bilinearPoint(edgedists, point)
 
 def gradientAscent(edgedists, edgedirs, point):
     """
@@ -300,11 +436,13 @@ def gradientAscent(edgedists, edgedirs, point):
             break
         bestDist = curdist
         bestPoint = point
-        if max(abs(edgedirs[tuple(intpoint)])) == 0:
+        # edgedirs may be integer (see computeEdgeDistancesCompact())
+        edgedir = edgedirs[tuple(intpoint)].astype(float)
+        if max(abs(edgedir)) == 0:
             # We might have been at a ledge, now we are out of the worm; discard
             #print "edgedirs zero"
             return None
-        walkDir = edgedirs[tuple(intpoint)] / max(abs(edgedirs[tuple(intpoint)]))
+        walkDir = edgedir / max(abs(edgedir))
         point = [point[0] - walkDir[0], point[1] - walkDir[1]]
         #print ">", bestPoint, bestDist, walkDir, point, curdist
         if point < [0,0] or point[0] >= edgedists.shape[0] or point[1] >= edgedists.shape[1]:
@@ -314,43 +452,53 @@ def gradientAscent(edgedists, edgedirs, point):
         steps += 1
     return bestPoint
 
-def filterPath(path, points, edgedists, edgedirs, uvframe):
+def filterPath(path, points, edgedists, edgedirs, uvframe, rng):
     """
     If two successive points in the path are nearer than MIN_POINT_DISTANCE,
-    one of them is removed. Then, an extra point is added inbetween each
-    pair of points and gradient-ascended to the middle of the worm.
+    one of them (picked using the random.Random instance @rng) is removed.
+    Then, an extra point is added inbetween each pair of points and
+    gradient-ascended to the middle of the worm.
     """
-    # Remove points that are too close
+    # Remove points that are too close; we only mark them in a mask
+    # while walking the path and compact it in one pass afterwards.
+    # @i is the current point and @j its (not yet removed) successor.
+    keep = numpy.ones(len(path), dtype = bool)
     i = 0
-    while i < len(path)-1:
+    j = 1
+    while j < len(path):
         point0 = points[path[i]]
-        point1 = points[path[i+1]]
+        point1 = points[path[j]]
         distance = (point0[0] - point1[0]) ** 2 + (point0[1] - point1[1]) ** 2
         if distance < MIN_POINT_DISTANCE ** 2:
-            # Make sure we never remove the (currently) tip control points
+            # Make sure we never remove the (currently) tip control point
             if i == 0:
                 ofs = 1
-            elif i == len(path)-1:
-                ofs = 0
             else:
-                ofs = random.randint(0, 1)
-            path.pop(i + ofs)
+                ofs = rng.randint(0, 1)
+            if ofs:
+                keep[j] = False
+            else:
+                keep[i] = False
+                i = j
         else:
-            i += 1
+            i = j
+        j += 1
+    path = numpy.asarray(path)[keep]
 
     # Insert points in midway
-    newpath = []
+    midpoints = []
     for i in range(len(path)-1):
         point0 = points[path[i]]
         point1 = points[path[i+1]]
         point_mid = [round((point0[0] + point1[0]) / 2), round((point0[1] + point1[1]) / 2)]
-        point_mid = gradientAscent(edgedists, edgedirs, point_mid)
+        midpoints.append(gradientAscent(edgedists, edgedirs, point_mid))
 
-        points.append(point_mid)
-        newpath.append(path[i])
-        newpath.append(len(points)-1)
-    newpath.append(path[len(path)-1])
-    return newpath
+    # Interleave the path with indices of the midpoints
+    newpath = numpy.empty(len(path) * 2 - 1, dtype = int)
+    newpath[0::2] = path
+    newpath[1::2] = numpy.arange(len(points), len(points) + len(midpoints))
+    points.extend(midpoints)
+    return newpath.tolist()
 
 def extendToTip(ipoint0, ipoint1, points, edgedists, edgedirs, uvframe):
     """
@@ -376,8 +524,7 @@ def extendToTip(ipoint0, ipoint1, points, edgedists, edgedirs, uvframe):
 
         # Also consider other points that neighbor both point and
         # nextpoint, implementing the cone search.
-        nextpointset = [nextpoint]
-        nextpointround = [round(nextpoint[0]), round(nextpoint[1])]
+        nextpointofs = [[0, 0]]
         if nextpoint[0] == 0:
             yset = [-walkDirDim, walkDirDim]
         else:
@@ -386,18 +533,17 @@ def extendToTip(ipoint0, ipoint1, points, edgedists, edgedirs, uvframe):
             xset = [-walkDirDim, walkDirDim]
         else:
             xset = [nextpoint[1]-point[1], 0]
-        nextpointset += [nextpoint + [y,x] for x in xset for y in yset]
-        nextpoints = []
-        for p in nextpointset:
-            p_edgedist = edgedistsInterpolate(edgedists, p)
-            #print "considering", p, p_edgedist
-            if p_edgedist == 0 or p_edgedist is None:
-                # We are at the border, bye!
-                return point
-            nextpoints.append((p, p_edgedist))
-
-        # Pick the one furthest away from the edge
-        (point, dist) = max(nextpoints, key = lambda x: x[1])
+        nextpointofs += [[y,x] for x in xset for y in yset]
+        nextpoints = nextpoint + numpy.array(nextpointofs)
+        nextdists = samplelib.bilinearSample(edgedists, nextpoints)
+        #print "considering", nextpoints, nextdists
+        if (numpy.isnan(nextdists) | (nextdists == 0)).any():
+            # We are at the border, bye!
+            return point
+
+        # Pick the one furthest away from the edge (the first of equal ones)
+        best = numpy.argmax(nextdists)
+        (point, dist) = (nextpoints[best], nextdists[best])
         #print point, dist, "---", nextpoints
 
     return point
@@ -406,12 +552,16 @@ def addPoint(points, coord):
     points.append(coord)
     return len(points)-1
 
-def poseExtract(uvframe, edgedists, edgedirs):
+def poseExtract(uvframe, edgedists, edgedirs, rng, stats = None):
     """
     Output a sequence of coordinates of pose curve control points.
+    All randomness is drawn from the random.Random instance @rng.
+    If @stats dict is passed, extraction statistics are stored in it
+    (currently, "discarded" - the fraction of backbone control points
+    that walked out of the worm during gradient ascent).
     """
     # Pick a random sample of points
-    points = [sampleRandomPoint(uvframe) for i in range(NUM_SAMPLES)]
+    points = [sampleRandomPoint(uvframe, rng) for i in range(NUM_SAMPLES)]
 
     # Generate a backbone from the points set
     points = pointsDeduplicate(points)
@@ -435,6 +585,8 @@ def poseExtract(uvframe, edgedists, edgedirs):
         #print "---", i, points[i]
         points[i] = gradientAscent(edgedists, edgedirs, points[i])
         #print "->", points[i]
+    ncandidates = len(backbone)
+    ndiscarded = len([i for i in backbone if points[i] is None])
 
     points = pointsDeduplicate(points)
 
@@ -458,7 +610,14 @@ def poseExtract(uvframe, edgedists, edgedirs):
 
     # Filter the path by removing points too close to each other
     # and inserting points midway (gradient-ascended while at it).
-    backbone = filterPath(backbone, points, edgedists, edgedirs, uvframe)
+    backbone = filterPath(backbone, points, edgedists, edgedirs, uvframe, rng)
+
+    # Discard midpoints that walked out of the worm
+    ncandidates += len(backbone) / 2
+    ndiscarded += len([i for i in backbone if points[i] is None])
+    backbone = [i for i in backbone if points[i] is not None]
+    if stats is not None:
+        stats["discarded"] = ndiscarded / float(ncandidates)
 
     # Add some extra control points at both tips of the worm (or a tip and an edge)
     backbone = [
@@ -480,18 +639,127 @@ def poseExtract(uvframe, edgedists, edgedirs):
     # TODO: Extend tips by slowest-rate gradient descent
     return map(lambda i: points[i], backbone)
 
-def printTSV(backbone, edgedists):
-    for point in backbone:
-        print 0, point[0], point[1], edgedists[tuple(point)]
-
-def processFrame(i, node, ar, cw):
-    uvframe = hdf5lflib.compute_uvframe(node, ar, cw)
+def backboneQuality(backbone, edgedists):
+    """
+    Return a quality score of @backbone, higher being better: its length
+    weighted by the mean distance of its control points from the edge.
+    Backbones that stop short of the tips or meander away from the
+    central axis of the worm score lower.
+    """
+    length = sum([math.sqrt(pointSquaredDistance(backbone[i-1], backbone[i]))
+                  for i in range(1, len(backbone))])
+    dists = samplelib.bilinearSample(edgedists, [[p[0], p[1]] for p in backbone])
+    meandist = numpy.nansum(dists) / float(len(dists))
+    return length * meandist
 
+def backboneScore(backbone, edgedists, discarded, reflength = None):
+    """
+    Compute cheap quality metrics of @backbone, given the fraction of
+    @discarded control points (as reported by poseExtract()) and possibly
+    an expected backbone length @reflength (e.g. of neighbouring frames).
+    Return a dict of the metrics, with "ok" False and the reasons listed
+    in "failures" if the backbone looks like a failed extraction.
+    """
+    points = numpy.array([[p[0], p[1]] for p in backbone], dtype = float)
+    steps = numpy.diff(points, axis = 0)
+    steplens = numpy.sqrt((steps ** 2).sum(axis = 1))
+    length = steplens.sum()
+
+    # Edge distance profile (at nearest pixels); the tip points lie
+    # at the edge by design
+    ipoints = numpy.rint(points[1:-1]).astype(int)
+    ipoints[:, 0] = numpy.clip(ipoints[:, 0], 0, edgedists.shape[0] - 1)
+    ipoints[:, 1] = numpy.clip(ipoints[:, 1], 0, edgedists.shape[1] - 1)
+    dists = edgedists[ipoints[:, 0], ipoints[:, 1]]
+    offworm = (dists < MIN_EDGE_DISTANCE).mean() if len(dists) else 1.
+
+    # Turning angles between successive segments
+    steps = steps[steplens > 0]
+    norms = numpy.sqrt((steps ** 2).sum(axis = 1))
+    cosines = (steps[1:] * steps[:-1]).sum(axis = 1) / (norms[1:] * norms[:-1])
+    angles = numpy.degrees(numpy.arccos(numpy.clip(cosines, -1., 1.)))
+    spikes = int((angles > MAX_TURN_ANGLE).sum())
+
+    # Segment lengths, excluding the tip extensions
+    inner = steplens[1:-1]
+    stepratio = inner.max() / numpy.median(inner) if len(inner) else 0.
+
+    score = {
+        "length": float(length),
+        "quality": float(backboneQuality(backbone, edgedists)),
+        "edgedist_mean": float(dists.mean()) if len(dists) else 0.,
+        "edgedist_min": float(dists.min()) if len(dists) else 0.,
+        "offworm": float(offworm),
+        "curvature_spikes": spikes,
+        "step_ratio": float(stepratio),
+        "discarded": float(discarded),
+    }
+    failures = []
+    if discarded > MAX_DISCARDED_FRACTION:
+        failures.append("discarded")
+    if offworm > MAX_OFFWORM_FRACTION:
+        failures.append("offworm")
+    if spikes > MAX_CURVATURE_SPIKES:
+        failures.append("curvature_spikes")
+    if stepratio > MAX_STEP_RATIO:
+        failures.append("step_ratio")
+    if reflength:
+        score["relative_length"] = float(length / reflength)
+        if abs(length / reflength - 1.) > MAX_LENGTH_DEVIATION:
+            failures.append("relative_length")
+    score["failures"] = failures
+    score["ok"] = not failures
+    return score
+
+def _poseExtractSeeded(args):
+    (uvframe, edgedists, edgedirs, seed, reflength) = args
+    stats = {}
+    backbone = poseExtract(uvframe, edgedists, edgedirs, random.Random(seed), stats)
+    return (backboneScore(backbone, edgedists, stats["discarded"], reflength), backbone)
+
+def poseExtractRestarts(uvframe, edgedists, edgedirs, seed, restarts, reflength = None):
+    """
+    Run @restarts independent poseExtract() samplings in parallel worker
+    processes, with seeds derived from @seed, and return a (backbone,
+    score) tuple of the best backbone - preferring those that pass
+    backboneScore() checks, then by the quality score.
+    """
+    seedrng = random.Random(seed)
+    jobs = [(uvframe, edgedists, edgedirs, seedrng.randint(0, 2**31 - 1), reflength)
+            for i in range(restarts)]
+    # Worker processes (see blobsExtract()) may not start their own workers
+    if restarts > 1 and not multiprocessing.current_process().daemon:
+        pool = multiprocessing.Pool(min(restarts, multiprocessing.cpu_count()))
+        try:
+            results = pool.map(_poseExtractSeeded, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_poseExtractSeeded, jobs)
+    # max() picks the first of equal scores, keeping the choice deterministic
+    (score, backbone) = max(results, key = lambda r: (r[0]["ok"], r[0]["quality"]))
+    return (backbone, score)
+
+def printTSV(backbone, edgedists, out = None):
+    if out is None:
+        out = sys.stdout
+    for (point, edgedist) in zip(backbone, edgedists):
+        print >>out, 0, point[0], point[1], edgedist
+
+def frameMask(uvframe):
+    """
+    Convert @uvframe to a "blob mask" with the body of the worm True
+    and the rest False. In the LOW_MEMORY mode, @uvframe is overwritten.
+    """
     if PROGRESS_FIGURES:
         plt.figure()
         imgplot = plt.imshow(uvframe, cmap=plt.cm.gray)
         plt.show()
 
+    if LOW_MEMORY:
+        return frameMaskInPlace(uvframe)
+
     # Smooth twice
     uvframe = cv2.medianBlur(uvframe, 5)
     uvframe = cv2.medianBlur(uvframe, 5)
@@ -515,8 +783,32 @@ def processFrame(i, node, ar, cw):
         imgplot = plt.imshow(uvframe, cmap=plt.cm.gray)
         plt.show()
 
+    return uvframe
+
+def frameMaskInPlace(uvframe):
+    """
+    Like frameMask(), but smoothing @uvframe in place and keeping at most
+    one more full-frame buffer alive at a time.
+    """
+    buf = cv2.medianBlur(uvframe, 5)
+    cv2.medianBlur(buf, 5, uvframe)
+    del buf
+
+    mask = uvframe > uvframe.mean()
+    scipy.ndimage.morphology.binary_fill_holes(mask, output = mask)
+    return mask
+
+def maskExtract(uvframe, seed = 0, restarts = 1, retries = 0, reflength = None):
+    """
+    Extract the backbone from blob mask @uvframe. Return a tuple
+    (backbone, edgedists, score) where @edgedists are the edge
+    distances of the backbone points.
+    """
     # Annotate with information regarding the nearest edge
-    (edgedists, edgedirs) = computeEdgeDistances(uvframe)
+    if LOW_MEMORY:
+        (edgedists, edgedirs) = computeEdgeDistancesCompact(uvframe)
+    else:
+        (edgedists, edgedirs) = computeEdgeDistances(uvframe)
 
     if PROGRESS_FIGURES:
         fig, axes = plt.subplots(ncols = 2)
@@ -524,24 +816,345 @@ def processFrame(i, node, ar, cw):
         axes[1].imshow(edgedists)
         plt.show()
 
-    # Determine the backbone
-    backbone = poseExtract(uvframe, edgedists, edgedirs)
+    # Determine the backbone, retrying with fresh seeds on failure
+    if restarts > 1:
+        (backbone, score) = poseExtractRestarts(uvframe, edgedists, edgedirs, seed, restarts, reflength)
+    else:
+        stats = {}
+        backbone = poseExtract(uvframe, edgedists, edgedirs, random.Random(seed), stats)
+        score = backboneScore(backbone, edgedists, stats["discarded"], reflength)
+    seedrng = random.Random(seed)
+    while not score["ok"] and retries > 0:
+        retries -= 1
+        (backbone, score) = poseExtractRestarts(uvframe, edgedists, edgedirs,
+                seedrng.randint(0, 2**31 - 1), restarts, reflength)
+
+    return (backbone, [edgedists[tuple(point)] for point in backbone], score)
+
+def frameBlobs(mask):
+    """
+    Split blob mask @mask into its connected blobs of at least MIN_BLOB_AREA
+    pixels. Return a list of (mask, origin) tuples with the mask of each
+    blob cropped to its bounding box (plus BLOB_MARGIN) and the [y, x]
+    origin of the crop in the frame. The blobs are ordered by decreasing
+    area (then by position), to keep the order deterministic; see
+    matchBlobs() for ids of blobs across frames.
+    """
+    (labels, nlabels) = ndimage.label(mask, ndimage.generate_binary_structure(2, 2))
+    areas = numpy.bincount(labels.ravel())
+    blobs = []
+    for (label, (sy, sx)) in enumerate(ndimage.find_objects(labels), 1):
+        if areas[label] < MIN_BLOB_AREA:
+            continue
+        y0 = max(sy.start - BLOB_MARGIN, 0)
+        x0 = max(sx.start - BLOB_MARGIN, 0)
+        crop = (slice(y0, sy.stop + BLOB_MARGIN), slice(x0, sx.stop + BLOB_MARGIN))
+        blobs.append((-areas[label], y0, x0, label, crop))
+    blobs.sort()
+    return [(labels[crop] == label, [y0, x0]) for (area, y0, x0, label, crop) in blobs]
+
+def _blobExtract(args):
+    (mask, origin, seed, restarts, retries, reflength) = args
+    (backbone, edgedists, score) = maskExtract(mask, seed, restarts, retries, reflength)
+    return ([[p[0] + origin[0], p[1] + origin[1]] for p in backbone], edgedists, score)
+
+def blobsExtract(mask, seed = 0, restarts = 1, retries = 0, reflength = None):
+    """
+    Extract the backbone of each blob of blob mask @mask (see frameBlobs())
+    separately, in parallel worker processes if there are several blobs.
+    Return a list of (backbone, edgedists, score) tuples like maskExtract(),
+    indexed by blob id.
+    """
+    jobs = [(blobmask, origin, seed, restarts, retries, reflength)
+            for (blobmask, origin) in frameBlobs(mask)]
+    if len(jobs) > 1:
+        pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()))
+        try:
+            return pool.map(_blobExtract, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return map(_blobExtract, jobs)
+
+def _extractionParams(seed, restarts, retries, reflength):
+    return {"seed": seed, "restarts": restarts, "retries": retries, "reflength": reflength,
+            "settings": dict([(name, globals()[name]) for name in EXTRACTION_SETTINGS])}
+
+def _packResult(result, backbone, edgedists, score, suffix = ''):
+    result["backbone" + suffix] = numpy.array([[p[0], p[1]] for p in backbone], dtype = float)
+    result["edgedists" + suffix] = numpy.array(edgedists, dtype = float)
+    result["score" + suffix] = numpy.array(json.dumps(score))
+    return result
+
+def _unpackResult(result, suffix = ''):
+    return (result["backbone" + suffix].tolist(), result["edgedists" + suffix].tolist(),
+            json.loads(str(result["score" + suffix])))
+
+def frameExtract(h5file, frameNo, mask, seed = 0, restarts = 1, retries = 0, reflength = None):
+    """
+    Like maskExtract(), for frame @frameNo of @h5file, reusing the result
+    of earlier runs from the store if the frame and all the extraction
+    parameters are the same. @mask is a function returning the blob mask.
+    """
+    params = _extractionParams(seed, restarts, retries, reflength)
+    compute = lambda: _packResult({}, *maskExtract(mask(), seed, restarts, retries, reflength))
+    (key, result) = storelib.cached('backbone', params, [uvcachelib.uvframe_key(h5file, frameNo)], compute)
+    return _unpackResult(result)
 
-    # Convert to TSV and output
-    printTSV(backbone, edgedists)
+def frameBlobsExtract(h5file, frameNo, mask, seed = 0, restarts = 1, retries = 0, reflength = None):
+    """
+    Like blobsExtract(), for frame @frameNo of @h5file, reusing the results
+    from the store as frameExtract() does.
+    """
+    params = _extractionParams(seed, restarts, retries, reflength)
+    def compute():
+        results = blobsExtract(mask(), seed, restarts, retries, reflength)
+        stored = {"nblobs": numpy.array(len(results))}
+        for (blobid, result) in enumerate(results):
+            _packResult(stored, *result, suffix = str(blobid))
+        return stored
+    (key, result) = storelib.cached('blobs', params, [uvcachelib.uvframe_key(h5file, frameNo)], compute)
+    return [_unpackResult(result, str(blobid)) for blobid in range(int(result["nblobs"]))]
+
+def interpolateBackbone(backbone0, backbone1, beta, uvframe):
+    """
+    Interpolate a backbone in blob mask @uvframe at position @beta
+    (0 to 1) between (arc-length resampled) @backbone0 and @backbone1.
+    Return a tuple (backbone, edgedists, score) like maskExtract(),
+    the score only checking the fraction of points off the worm.
+    """
+    if (numpy.abs(backbone0 - backbone1[::-1]).sum()
+            < numpy.abs(backbone0 - backbone1).sum()):
+        # The extraction may have picked the other tip to start with
+        backbone1 = backbone1[::-1]
+    backbone = backbone0 * (1. - beta) + backbone1 * beta
+
+    # Cheap check using the vectorized floodfill, so that the edge
+    # distances output are of the same (grid-approximated) kind as
+    # those of the extracted keyframes
+    (edgedists, edgedirs) = computeEdgeDistancesCompact(uvframe)
+    ipoints = numpy.rint(backbone).astype(int)
+    ipoints[:, 0] = numpy.clip(ipoints[:, 0], 0, uvframe.shape[0] - 1)
+    ipoints[:, 1] = numpy.clip(ipoints[:, 1], 0, uvframe.shape[1] - 1)
+    dists = edgedists[ipoints[:, 0], ipoints[:, 1]]
+    offworm = (dists[1:-1] < MIN_EDGE_DISTANCE).mean()
+
+    score = {"interpolated": True, "offworm": float(offworm)}
+    score["failures"] = ["offworm"] if offworm > MAX_OFFWORM_FRACTION else []
+    score["ok"] = not score["failures"]
+    return (backbone.tolist(), dists.astype(float).tolist(), score)
+
+def backboneLength(backbone):
+    points = numpy.array([[p[0], p[1]] for p in backbone], dtype = float)
+    return numpy.sqrt((numpy.diff(points, axis = 0) ** 2).sum(axis = 1)).sum()
+
+def printPeakMemory(out = None):
+    """
+    Print peak resident memory of this process and of the largest of its
+    finished worker processes to @out (stderr by default).
+    """
+    if out is None:
+        out = sys.stderr
+    # ru_maxrss is in bytes on OS X, in kilobytes elsewhere
+    unit = 1024. * 1024. if sys.platform == 'darwin' else 1024.
+    selfrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    childrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    print >>out, "peak memory: %.1f MiB (workers: %.1f MiB)" % (selfrss, childrss)
+
+def processFrames(h5file, frames, outpattern, scorepattern = None,
+                  seed = 0, restarts = 1, retries = 0, reflength = None,
+                  keyframes = 1, maxdiff = None):
+    """
+    Extract backbones of @frames of @h5file, writing them to files named
+    by @outpattern (and scores by @scorepattern) with frame numbers filled
+    in. Full extraction happens only for keyframes: every @keyframes-th
+    frame and any frame whose blob mask differs from the last keyframe
+    in more than @maxdiff fraction of the worm area. Backbones of frames
+    in between are interpolated, or extracted too if that fails the check.
+    If @reflength is None, the previous keyframe backbone length is used.
+    Return the number of failed frames.
+    """
+    def output(frameNo, backbone, edgedists, score):
+        with open(outpattern % frameNo, 'w') as f:
+            printTSV(backbone, edgedists, f)
+        if scorepattern:
+            with open(scorepattern % frameNo, 'w') as f:
+                json.dump(score, f)
+        return 0 if score["ok"] else 1
+
+    def extract(frameNo, mask, lastlength):
+        return frameExtract(h5file, frameNo, lambda: mask, seed, restarts, retries, reflength or lastlength)
+
+    nfailed = 0
+    # Last keyframe (frame number, blob mask, extracted backbone)
+    # and the frames since then
+    keyframe = None
+    pending = []
+    lastlength = None
+
+    for (i, frameNo) in enumerate(frames):
+        mask = frameMask(uvcachelib.load_uvframe(h5file, frameNo))
+
+        if keyframe is not None and i < len(frames) - 1:
+            diff = numpy.count_nonzero(mask ^ keyframe[1]) / float(max(numpy.count_nonzero(keyframe[1]), 1))
+            if len(pending) + 1 < keyframes and (maxdiff is None or diff <= maxdiff):
+                pending.append((frameNo, mask))
+                continue
 
-def processFile(filename, frameNo):
-    h5file = tables.open_file(filename, mode = "r")
-    ar = h5file.get_node('/', '/autorectification')
-    try:
-        cw = h5file.get_node('/', '/cropwindow')
-    except tables.NoSuchNodeError:
-        cw = None
-    processFrame(frameNo, h5file.get_node('/', '/images/' + str(frameNo)), ar, cw)
-    return True
+        result = extract(frameNo, mask, lastlength)
+        nfailed += output(frameNo, *result)
+        if result[2]["ok"]:
+            lastlength = backboneLength(result[0])
+
+        # Interpolate the frames since the last keyframe
+        if pending:
+            npoints = max(len(keyframe[2]), len(result[0]))
+            backbone0 = poselib.bbResample([[p[0], p[1]] for p in keyframe[2]], npoints)
+            backbone1 = poselib.bbResample([[p[0], p[1]] for p in result[0]], npoints)
+            for (j, (pFrameNo, pMask)) in enumerate(pending):
+                beta = (j + 1) / float(len(pending) + 1)
+                presult = interpolateBackbone(backbone0, backbone1, beta, pMask)
+                if not presult[2]["ok"]:
+                    presult = extract(pFrameNo, pMask, lastlength)
+                nfailed += output(pFrameNo, *presult)
+
+        keyframe = (frameNo, mask, result[0])
+        pending = []
+
+    return nfailed
+
+def matchBlobs(backbones, prevcenters, nextid):
+    """
+    Assign ids to blobs with @backbones, given a dict @prevcenters of
+    backbone centroids of the blobs of the previous frame by their ids.
+    Nearest pairs of blobs less than MAX_BLOB_SHIFT apart are matched
+    first; the other blobs get new ids counting from @nextid. Return
+    a tuple (ids, centers, nextid) with the ids, a dict of the centroids
+    of this frame by the ids and the next free id.
+    """
+    centers = [numpy.array([[p[0], p[1]] for p in backbone], dtype = float).mean(axis = 0)
+               if backbone else None for backbone in backbones]
+    pairs = []
+    for (i, center) in enumerate(centers):
+        if center is None:
+            continue
+        for (blobid, prevcenter) in prevcenters.items():
+            dist = math.sqrt(pointSquaredDistance(center, prevcenter))
+            if dist < MAX_BLOB_SHIFT:
+                pairs.append((dist, i, blobid))
+
+    ids = [None] * len(backbones)
+    for (dist, i, blobid) in sorted(pairs):
+        if ids[i] is None and blobid not in ids:
+            ids[i] = blobid
+    for i in range(len(ids)):
+        if ids[i] is None:
+            ids[i] = nextid
+            nextid += 1
+    return (ids, dict([(blobid, center) for (blobid, center) in zip(ids, centers)
+                       if center is not None]), nextid)
+
+def processFrameBlobs(h5file, frames, outpattern, scorepattern = None,
+                      seed = 0, restarts = 1, retries = 0, reflength = None):
+    """
+    Extract backbones of all blobs of @frames of @h5file, writing them
+    to files named by @outpattern (and scores by @scorepattern) with the
+    frame number and blob id (see matchBlobs()) filled in. Return
+    the number of failed blobs and frames without any blob. Blob ids
+    start from 0 with the first of @frames.
+    """
+    nfailed = 0
+    centers = {}
+    nextid = 0
+    for frameNo in frames:
+        mask = lambda: frameMask(uvcachelib.load_uvframe(h5file, frameNo))
+        results = frameBlobsExtract(h5file, frameNo, mask, seed, restarts, retries, reflength)
+        if not results:
+            # Nothing to write; blobs of the previous frame keep their
+            # ids if they show up again in the next one
+            print >>sys.stderr, "No blobs in frame %d" % frameNo
+            nfailed += 1
+            continue
+        (ids, centers, nextid) = matchBlobs([r[0] for r in results], centers, nextid)
+        for (blobid, (backbone, edgedists, score)) in zip(ids, results):
+            with open(outpattern % (frameNo, blobid), 'w') as f:
+                printTSV(backbone, edgedists, f)
+            if scorepattern:
+                with open(scorepattern % (frameNo, blobid), 'w') as f:
+                    json.dump(score, f)
+            if not score["ok"]:
+                nfailed += 1
+    return nfailed
+
+def processFile(filename, frameNo, seed = 0, restarts = 1, retries = 0, reflength = None, scorefile = None):
+    h5file = uvcachelib.open_h5file(filename)
+    mask = lambda: frameMask(uvcachelib.load_uvframe(h5file, frameNo))
+    (backbone, edgedists, score) = frameExtract(h5file, frameNo, mask, seed, restarts, retries, reflength)
+    printTSV(backbone, edgedists)
+    if scorefile:
+        with open(scorefile, 'w') as f:
+            json.dump(score, f)
+    return score["ok"]
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog = 'pose-extract-lf.py')
+    parser.add_argument('-s', '--seed', type = int, default = 0)
+    parser.add_argument('-k', '--restarts', type = int, default = 1)
+    parser.add_argument('-r', '--retries', type = int, default = 0)
+    parser.add_argument('-l', '--length', type = float, default = None)
+    parser.add_argument('-q', '--score', default = None)
+    parser.add_argument('-o', '--output', default = None)
+    parser.add_argument('-K', '--keyframes', type = int, default = 1)
+    parser.add_argument('-d', '--maxdiff', type = float, default = None)
+    parser.add_argument('-M', '--low-memory', action = 'store_true')
+    parser.add_argument('-b', '--blobs', action = 'store_true')
+    parser.add_argument('filename')
+    parser.add_argument('frames')
+    args = parser.parse_args(argv)
+
+    global LOW_MEMORY
+    LOW_MEMORY = args.low_memory
+
+    if args.blobs:
+        if not args.output:
+            parser.error('-b requires -o OUTPATTERN')
+        if args.keyframes != 1:
+            parser.error('-b cannot be combined with -K')
+        h5file = uvcachelib.open_h5file(args.filename)
+        if '-' in args.frames:
+            (first, last) = [int(f) for f in args.frames.split('-')]
+            frames = [f for f in uvcachelib.list_frames(h5file) if first <= f <= last]
+        else:
+            frames = [int(args.frames)]
+        nfailed = processFrameBlobs(h5file, frames, args.output, args.score, args.seed,
+                                    args.restarts, args.retries, args.length)
+        storelib.report()
+        if LOW_MEMORY:
+            printPeakMemory()
+        return 2 if nfailed > 0 else 0
+
+    if '-' not in args.frames:
+        ok = processFile(args.filename, int(args.frames), args.seed, args.restarts,
+                         args.retries, args.length, args.score)
+        if LOW_MEMORY:
+            printPeakMemory()
+        if not ok:
+            return 2
+        return 0
+
+    if not args.output:
+        parser.error('a frame range requires -o OUTPATTERN')
+    h5file = uvcachelib.open_h5file(args.filename)
+    (first, last) = [int(f) for f in args.frames.split('-')]
+    frames = [f for f in uvcachelib.list_frames(h5file) if first <= f <= last]
+    nfailed = processFrames(h5file, frames, args.output, args.score, args.seed, args.restarts,
+                            args.retries, args.length, args.keyframes, args.maxdiff)
+    storelib.report()
+    if LOW_MEMORY:
+        printPeakMemory()
+    if nfailed > 0:
+        return 2
+    return 0
 
 if __name__ == '__main__':
-    filename = sys.argv[1]
-    frameNo = int(sys.argv[2])
-    if not processFile(filename, frameNo):
-        sys.exit(1)
+    sys.exit(main(sys.argv[1:]))
@@ -12,6 +12,8 @@ import numpy
 import os
 import scipy.interpolate as interp
 
+import storelib
+
 
 def bbReadTSV(f):
     """
@@ -23,8 +25,8 @@ def bbReadTSV(f):
     edgedists = []
     for line in f:
         items = line.strip().split()
-        points.append(items[0:2])
-        edgedists.append(item[3])
+        points.append([float(v) for v in items[0:3]])
+        edgedists.append(float(items[3]))
     return (points, edgedists)
 
 def bbReadJSON(f):
@@ -58,6 +60,40 @@ def bbLoad(bbfilename):
 
     return (points, edgedists)
 
+def bbWriteTSV(f, points, edgedists):
+    """
+    Write backbone @points (3D coordinates in the z,y,x order) and
+    @edgedists as TSV data to @f, in the format read by bbReadTSV().
+    """
+    for (point, edgedist) in zip(points, edgedists):
+        f.write('%s\t%s\t%s\t%s\n' % (point[0], point[1], point[2], edgedist))
+
+def bbWriteJSON(f, points, edgedists):
+    """
+    Write backbone @points (3D coordinates in the z,y,x order) and
+    @edgedists as JSON data to @f, in the format read by bbReadJSON().
+    """
+    json.dump({"bbpoints": [[point[2], point[1], point[0], edgedist]
+                            for (point, edgedist) in zip(points, edgedists)]}, f)
+    f.write('\n')
+
+def bbSave(bbfilename, points, edgedists):
+    """
+    Save backbone information to a file in one of the formats supported
+    by bbLoad().
+    """
+    bbext = os.path.splitext(bbfilename)[1]
+
+    if bbext == '.tsv':
+        writer = bbWriteTSV
+    elif bbext == '.json':
+        writer = bbWriteJSON
+    else:
+        raise ValueError('Unknown backbone data extension ' + bbext)
+
+    with open(bbfilename, 'w') as bbfile:
+        writer(bbfile, points, edgedists)
+
 
 def bbToSpline(points):
     """
@@ -85,6 +121,19 @@ def bbToSpline(points):
     return ([ytck, xtck], int(totdist))
 
 
+def bbResample(points, n):
+    """
+    Resample a backbone given by a sequence of @points to @n points
+    equidistant along its arc length. Returns an (n, dim) array.
+    """
+    points = numpy.asarray(points, dtype = float)
+    seglens = numpy.sqrt((numpy.diff(points, axis = 0) ** 2).sum(axis = 1))
+    arclen = numpy.concatenate([[0.], numpy.cumsum(seglens)])
+    ticker = numpy.linspace(0., arclen[-1], n)
+    return numpy.column_stack([numpy.interp(ticker, arclen, points[:, i])
+                               for i in range(points.shape[1])])
+
+
 def bbTraceSpline(spline, bbpixels, uvframe = None):
     """
     Convert a backbone spline to a list of coordinates of pixels belonging
@@ -180,3 +229,46 @@ def projTranslateByBb(coord, bbpoints, name, poseinfo):
     #    print("====", c)
 
     return [c[1], c[0]]
+
+def projNeuron(neuron, bbpoints, poseinfo):
+    """
+    Project @neuron (as loaded by nmllib) to the imaged worm pose given
+    by traced @bbpoints and @poseinfo. Return a tuple of xy soma position
+    and radius, or None if the neuron lies beyond the backbone.
+    """
+    pos = projTranslateByBb(projCoord(neuron["pos"], poseinfo), bbpoints, neuron["name"], poseinfo)
+    if pos is None:
+        return None
+    return (pos, projDiameter(neuron["diameter"], poseinfo) / 2.)
+
+def projNeurons(neurons, bbpoints, poseinfo):
+    """
+    Project all @neurons like projNeuron(). Return a dict with "centers",
+    an array of yx soma positions (NaN for neurons beyond the backbone)
+    and "radii", an array of soma radii.
+    """
+    centers = numpy.empty((len(neurons), 2))
+    centers.fill(numpy.nan)
+    radii = numpy.zeros(len(neurons))
+    for (i, n) in enumerate(neurons):
+        proj = projNeuron(n, bbpoints, poseinfo)
+        if proj is None:
+            continue
+        # Projected positions are in the xy order
+        centers[i] = [proj[0][1], proj[0][0]]
+        radii[i] = proj[1]
+    return {"centers": centers, "radii": radii}
+
+def bbProjNeurons(bbfilename, neurons, poseinfo, neuronskey):
+    """
+    Return projNeurons() of @neurons by backbone from @bbfilename and
+    @poseinfo, reusing the result stored by storelib if available.
+    @neuronskey is a digest of the @neurons data.
+    """
+    def project():
+        (points, edgedists) = bbLoad(bbfilename)
+        (spline, bblength) = bbToSpline(points)
+        return projNeurons(neurons, bbTraceSpline(spline, bblength), poseinfo)
+    (key, proj) = storelib.cached('neurons', {"poseinfo": poseinfo},
+            [storelib.file_digest(bbfilename), neuronskey], project)
+    return proj
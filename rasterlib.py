@@ -0,0 +1,116 @@
+# Library with tools for working with pixel areas of uvframes
+#
+# stencil = a pair of (dy, dx) integer offset arrays of pixels
+# covering some shape (e.g. a soma disc) centered at [0, 0]
+#
+# rgb = a (height, width, 3) uint8 array with a rendered image
+
+import math
+import numpy
+
+
+def discStencil(radius):
+    """
+    Return a stencil of pixels within a disc of @radius.
+    """
+    r = int(math.ceil(radius))
+    (yy, xx) = numpy.mgrid[-r:r+1, -r:r+1]
+    inside = yy ** 2 + xx ** 2 <= radius ** 2
+    return (yy[inside], xx[inside])
+
+def circleStencil(radius):
+    """
+    Return a stencil of pixels on a circle of @radius.
+    """
+    r = int(math.ceil(radius)) + 1
+    (yy, xx) = numpy.mgrid[-r:r+1, -r:r+1]
+    onring = numpy.abs(numpy.sqrt(yy ** 2 + xx ** 2) - radius) <= 0.5
+    return (yy[onring], xx[onring])
+
+def stencilCache(shape = discStencil):
+    """
+    Return a function mapping a radius to its @shape stencil, computing
+    each stencil only once. Radii are rounded to 1/10 of a pixel.
+    """
+    stencils = {}
+    def stencil(radius):
+        key = round(radius, 1)
+        if key not in stencils:
+            stencils[key] = shape(key)
+        return stencils[key]
+    return stencil
+
+def placeStencils(imshape, centers, stencils):
+    """
+    Place all @stencils at @centers (a sequence of [y, x] coordinates,
+    rounded to the nearest pixel; None for stencils that should be
+    skipped) at once. Return a tuple (used, sizes, labels, yy, xx, inside)
+    where @used lists indices of placed stencils, @sizes their pixel counts,
+    and @labels, @yy, @xx and @inside tell for each placed pixel which of
+    the used stencils it belongs to, its coordinates and whether it lies
+    within image of @imshape.
+    """
+    used = [i for i in range(len(stencils)) if centers[i] is not None]
+    sizes = numpy.array([len(stencils[i][0]) for i in used], dtype = int)
+    labels = numpy.repeat(numpy.arange(len(used)), sizes)
+    if not used:
+        empty = numpy.zeros(0, dtype = int)
+        return (used, sizes, labels, empty, empty, empty.astype(bool))
+
+    c = numpy.rint(numpy.array([centers[i] for i in used], dtype = float)).astype(int)
+    yy = numpy.concatenate([stencils[i][0] for i in used]) + c[labels, 0]
+    xx = numpy.concatenate([stencils[i][1] for i in used]) + c[labels, 1]
+    inside = (yy >= 0) & (xx >= 0) & (yy < imshape[0]) & (xx < imshape[1])
+    return (used, sizes, labels, yy, xx, inside)
+
+def stencilSums(image, centers, stencils):
+    """
+    Integrate @image over @stencils placed at @centers (see placeStencils()).
+    Return an array with a sum for each stencil, or NaN if the stencil
+    was skipped or does not fit the image entirely.
+    """
+    sums = numpy.empty(len(stencils))
+    sums.fill(numpy.nan)
+    (used, sizes, labels, yy, xx, inside) = placeStencils(image.shape, centers, stencils)
+    if not used:
+        return sums
+
+    values = image[yy[inside], xx[inside]].astype(float)
+    usedsums = numpy.bincount(labels[inside], weights = values, minlength = len(used))
+    counts = numpy.bincount(labels[inside], minlength = len(used))
+    usedsums[counts < sizes] = numpy.nan
+    sums[used] = usedsums
+    return sums
+
+
+def grayToRGB(image, scale = 1):
+    """
+    Return an rgb rendering of grayscale @image, with intensities
+    stretched to the full range and each pixel upscaled to a square
+    of @scale x @scale.
+    """
+    image = numpy.asarray(image, dtype = float)
+    (lo, hi) = (image.min(), image.max())
+    if hi > lo:
+        image = (image - lo) * (255. / (hi - lo))
+    gray = image.astype(numpy.uint8)
+    if scale > 1:
+        gray = numpy.repeat(numpy.repeat(gray, scale, axis = 0), scale, axis = 1)
+    return numpy.dstack([gray, gray, gray])
+
+def drawPoints(rgb, coords, color):
+    """
+    Paint pixels at @coords (an (n, 2) array of [y, x] coordinates,
+    rounded to the nearest pixel) in @rgb with @color.
+    """
+    c = numpy.rint(numpy.asarray(coords, dtype = float)).astype(int).reshape(-1, 2)
+    inside = (c[:, 0] >= 0) & (c[:, 1] >= 0) & (c[:, 0] < rgb.shape[0]) & (c[:, 1] < rgb.shape[1])
+    rgb[c[inside, 0], c[inside, 1]] = color
+
+def drawStencils(rgb, centers, stencils, color):
+    """
+    Paint @stencils placed at @centers (see placeStencils()) in @rgb
+    with @color.
+    """
+    (used, sizes, labels, yy, xx, inside) = placeStencils(rgb.shape, centers, stencils)
+    rgb[yy[inside], xx[inside]] = color
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# render-overlay - render frames of a whole recording with backbones
+# and NeuroML neuron positions interposed, for visual review
+#
+# Usage: render-overlay.py [-j JOBS] [-f FIRST-LAST] [-s SCALE] [-r FPS] HDF5FILE BACKBONEPATTERN POSEINFO NEUROML2DIR OUTPUT
+#
+# BACKBONEPATTERN, POSEINFO and NEUROML2DIR are as in extract-traces.py;
+# frames without a backbone file are skipped.
+#
+# If OUTPUT contains a %d-style placeholder (e.g. "overlay/%05d.png"),
+# an image sequence is written with the frame number filled in;
+# otherwise, OUTPUT is a video file (MJPG-encoded at FPS frames per
+# second, e.g. "overlay.avi").
+#
+# The frames are rendered as RGB arrays, upscaled SCALE times (4 by
+# default), in JOBS parallel worker processes (all cpus by default).
+# This is a batch counterpart of interpose-neuroml.py.
+
+import argparse
+import collections
+import multiprocessing
+import sys
+
+import cv2
+import numpy
+
+import nmllib
+import poselib
+import rasterlib
+import storelib
+import uvcachelib
+
+
+BACKBONE_COLOR = (255, 255, 0)
+NEURON_COLOR = (0, 255, 0)
+# Soma circles are drawn at this scale of the NeuroML diameter,
+# the same as in interpose-neuroml.py.
+SOMA_RADIUS_SCALE = 1 / 10.
+FOURCC = 'MJPG'
+# Frames rendered ahead of the writer, per worker process
+MAX_PENDING_PER_JOB = 2
+
+
+def renderFrame(uvframe, bbpoints, neurons, proj, scale, circle):
+    """
+    Return an rgb array with @uvframe upscaled @scale times, the traced
+    backbone @bbpoints and @neurons (projected to @proj as returned by
+    poselib.projNeurons()) drawn in, using @circle (a stencilCache())
+    to get the neuron circle stencils.
+    """
+    rgb = rasterlib.grayToRGB(uvframe, scale)
+    # Center of an original pixel in the upscaled image
+    upscale = lambda c: (numpy.asarray(c, dtype = float) + 0.5) * scale - 0.5
+
+    rasterlib.drawPoints(rgb, upscale(bbpoints[:, 0]), BACKBONE_COLOR)
+
+    centers = []
+    stencils = []
+    labels = []
+    for (n, c, r) in zip(neurons, proj["centers"], proj["radii"]):
+        if numpy.isnan(c[0]):
+            continue
+        centers.append(upscale(c))
+        stencils.append(circle(r * SOMA_RADIUS_SCALE * scale))
+        labels.append(n["name"])
+    rasterlib.drawStencils(rgb, centers, stencils, NEURON_COLOR)
+
+    for (c, label) in zip(centers, labels):
+        cv2.putText(rgb, str(label), (int(c[1]), int(c[0])),
+                    cv2.FONT_HERSHEY_PLAIN, 0.8, NEURON_COLOR)
+    return rgb
+
+# Per-process job parameters, set by _initWorker()
+_job = None
+
+def _initWorker(job):
+    global _job
+    _job = job
+    _job["circle"] = rasterlib.stencilCache(rasterlib.circleStencil)
+
+def _renderFrame(frameNo):
+    h5file = uvcachelib.open_h5file(_job["filename"])
+    uvframe = uvcachelib.load_uvframe(h5file, frameNo)
+    bbfilename = _job["bbpattern"] % frameNo
+    try:
+        (points, edgedists) = poselib.bbLoad(bbfilename)
+    except IOError as e:
+        sys.stderr.write("Skipping frame %d: %s\n" % (frameNo, e))
+        return (frameNo, None, storelib.take_stats())
+    (spline, bblength) = poselib.bbToSpline(points)
+    bbpoints = poselib.bbTraceSpline(spline, bblength, uvframe)
+    proj = poselib.bbProjNeurons(bbfilename, _job["neurons"], _job["poseinfo"], _job["neuronskey"])
+    rgb = renderFrame(uvframe, bbpoints, _job["neurons"], proj, _job["scale"], _job["circle"])
+    return (frameNo, rgb, storelib.take_stats())
+
+def renderFrames(filename, frames, bbpattern, neurons, poseinfo, scale, jobs):
+    """
+    Yield (frameNo, rgb) tuples for each of @frames in order, rendered
+    in @jobs worker processes; rgb is None if the frame was skipped.
+    """
+    job = {"filename": filename, "bbpattern": bbpattern, "neurons": neurons,
+           "poseinfo": poseinfo, "scale": scale,
+           "neuronskey": storelib.text_digest(nmllib.jsondump_neurons(neurons))}
+
+    if jobs <= 1:
+        _initWorker(job)
+        for frameNo in frames:
+            (frameNo, rgb, stats) = _renderFrame(frameNo)
+            storelib.merge_stats(stats)
+            yield (frameNo, rgb)
+        return
+
+    pool = multiprocessing.Pool(jobs, _initWorker, (job,))
+    try:
+        # Keep at most MAX_PENDING_PER_JOB frames per worker in flight
+        # (unlike with imap(), which lets the workers run arbitrarily far
+        # ahead of a slower writer), so that finished full-size frames
+        # do not pile up in memory
+        pending = collections.deque()
+        for frameNo in frames:
+            pending.append(pool.apply_async(_renderFrame, (frameNo,)))
+            if len(pending) < MAX_PENDING_PER_JOB * jobs:
+                continue
+            (frameNo, rgb, stats) = pending.popleft().get()
+            storelib.merge_stats(stats)
+            yield (frameNo, rgb)
+        while pending:
+            (frameNo, rgb, stats) = pending.popleft().get()
+            storelib.merge_stats(stats)
+            yield (frameNo, rgb)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def writeFrames(output, results, fps):
+    """
+    Write rendered frames from @results to an image sequence or a video
+    file @output.
+    """
+    writer = None
+    try:
+        for (frameNo, rgb) in results:
+            if rgb is None:
+                continue
+            bgr = numpy.ascontiguousarray(rgb[:, :, ::-1])
+            if '%' in output:
+                cv2.imwrite(output % frameNo, bgr)
+                continue
+            if writer is None:
+                try:
+                    fourcc = cv2.VideoWriter_fourcc(*FOURCC)
+                except AttributeError:
+                    fourcc = cv2.cv.CV_FOURCC(*FOURCC)
+                writer = cv2.VideoWriter(output, fourcc, fps, (bgr.shape[1], bgr.shape[0]))
+            writer.write(bgr)
+    finally:
+        if writer is not None:
+            writer.release()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog = 'render-overlay.py')
+    parser.add_argument('-j', '--jobs', type = int, default = multiprocessing.cpu_count())
+    parser.add_argument('-f', '--frames', default = None)
+    parser.add_argument('-s', '--scale', type = int, default = 4)
+    parser.add_argument('-r', '--fps', type = float, default = 10.)
+    parser.add_argument('filename')
+    parser.add_argument('bbpattern')
+    parser.add_argument('poseinfo')
+    parser.add_argument('nmdir')
+    parser.add_argument('output')
+    args = parser.parse_args(argv)
+
+    poseinfo = dict(zip(["zoom", "shift", "angle"], [float(f) for f in args.poseinfo.split(',')]))
+    neurons = nmllib.load_neurons(args.nmdir)
+
+    frames = uvcachelib.list_frames(uvcachelib.open_h5file(args.filename))
+    if args.frames:
+        (first, last) = [int(f) for f in args.frames.split('-')]
+        frames = [f for f in frames if first <= f <= last]
+
+    results = renderFrames(args.filename, frames, args.bbpattern, neurons, poseinfo,
+                           args.scale, args.jobs)
+    writeFrames(args.output, results, args.fps)
+    storelib.report()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
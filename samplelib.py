@@ -0,0 +1,68 @@
+# Library for sampling images at sub-pixel coordinates
+#
+# coords = an array of [y, x] coordinates, of shape (..., 2); sampled
+# values come out in an array of the leading shape (...)
+#
+# Values are interpolated bilinearly from the four pixels around each
+# coordinate. Coordinates outside of the image, i.e. with any of the
+# four pixels missing, are never clamped or wrapped around; they get
+# a fill value instead.
+
+import math
+import numpy
+
+
+def bilinearWeights(imshape, coords):
+    """
+    Return a tuple (indices, weights, valid) for sampling images of
+    @imshape at @coords: @indices and @weights of the four (flattened)
+    pixels each value is interpolated from, in (..., 4) arrays, and
+    a boolean array telling whether the coordinate is within the image.
+    Invalid coordinates have zero weights and indices.
+    """
+    coords = numpy.asarray(coords, dtype = float)
+    (cy, cx) = (coords[..., 0], coords[..., 1])
+    valid = (cy >= 0) & (cx >= 0) & (cy <= imshape[0] - 1) & (cx <= imshape[1] - 1)
+
+    # Pixels at integer coordinates get the whole weight, so clipping
+    # the second pixel at the image border never affects the value
+    (y0, x0) = (numpy.floor(cy), numpy.floor(cx))
+    (by, bx) = (cy - y0, cx - x0)
+    y0 = numpy.clip(y0, 0, imshape[0] - 1).astype(int)
+    x0 = numpy.clip(x0, 0, imshape[1] - 1).astype(int)
+    y1 = numpy.minimum(y0 + 1, imshape[0] - 1)
+    x1 = numpy.minimum(x0 + 1, imshape[1] - 1)
+
+    weights = numpy.stack([(1-by) * (1-bx), (1-by) * bx, by * (1-bx), by * bx], axis = -1)
+    indices = numpy.stack([y0 * imshape[1] + x0, y0 * imshape[1] + x1,
+                           y1 * imshape[1] + x0, y1 * imshape[1] + x1], axis = -1)
+    weights[~valid] = 0.
+    indices[~valid] = 0
+    return (indices, weights, valid)
+
+def bilinearSample(image, coords, fill = numpy.nan):
+    """
+    Return an array of values of @image at @coords, with @fill for
+    coordinates outside of the image.
+    """
+    image = numpy.asarray(image)
+    (indices, weights, valid) = bilinearWeights(image.shape, coords)
+    values = (image.ravel()[indices] * weights).sum(axis = -1)
+    values[~valid] = fill
+    return values
+
+def bilinearPoint(image, point, fill = None):
+    """
+    Return the value of @image at a single @point, or @fill if it is
+    outside of the image. The same as bilinearSample(), only without
+    the array overhead, for use in loops walking one point at a time.
+    """
+    (y, x) = (float(point[0]), float(point[1]))
+    if not (0 <= y <= image.shape[0] - 1 and 0 <= x <= image.shape[1] - 1):
+        return fill
+    (y0, x0) = (int(math.floor(y)), int(math.floor(x)))
+    (by, bx) = (y - y0, x - x0)
+    y1 = min(y0 + 1, image.shape[0] - 1)
+    x1 = min(x0 + 1, image.shape[1] - 1)
+    return ((1-by) * (1-bx) * image[y0, x0] + (1-by) * bx * image[y0, x1]
+            + by * (1-bx) * image[y1, x0] + by * bx * image[y1, x1])
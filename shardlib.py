@@ -0,0 +1,162 @@
+# Shared work queue of frame-range shards
+#
+# A batch run of a tool over a long recording is split into shards of
+# consecutive frames, kept in a SQLite database on storage shared by all
+# the nodes taking part (see "sigextract.py shard").  Each node claims
+# pending shards one at a time and refreshes a heartbeat while working
+# on one; a running shard whose heartbeat is older than STALE_TIMEOUT
+# is considered abandoned (e.g. its node died) and is claimed again,
+# up to MAX_ATTEMPTS times.
+#
+# The tool arguments are templates: {first}, {last} and {shard} are
+# replaced by the first and last frame number and the id of the shard.
+# If an argument contains {frame}, the tool is run once for each frame
+# of the shard, with {frame} replaced by the frame number.
+
+import json
+import os
+import socket
+import sqlite3
+import time
+
+
+# Seconds between heartbeats of a running shard
+HEARTBEAT_INTERVAL = 30
+# Seconds since the last heartbeat after which a shard is abandoned
+STALE_TIMEOUT = 10 * HEARTBEAT_INTERVAL
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (tool TEXT, args TEXT);
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    first INTEGER,
+    last INTEGER,
+    state TEXT DEFAULT 'pending',
+    owner TEXT,
+    heartbeat REAL,
+    attempts INTEGER DEFAULT 0,
+    status INTEGER
+);
+"""
+
+
+def owner_id():
+    """
+    Return an id of this process, unique across the nodes.
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def open_queue(path):
+    """
+    Return a connection to the queue database at @path. Transactions
+    are started explicitly, as they need to lock the database for writing
+    right away.
+    """
+    conn = sqlite3.connect(path, timeout = 60, isolation_level = None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def create_queue(path, tool, args, first, last, shardsize):
+    """
+    Create a queue at @path of shards of @shardsize frames, covering
+    frames @first to @last inclusive, to be processed by @tool with
+    argument templates @args.
+    """
+    if os.path.exists(path):
+        raise ValueError('Queue %s already exists' % path)
+    conn = open_queue(path)
+    try:
+        conn.executescript(SCHEMA)
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('INSERT INTO queue VALUES (?, ?)', (tool, json.dumps(args)))
+        for start in range(first, last + 1, shardsize):
+            conn.execute('INSERT INTO shards (first, last) VALUES (?, ?)',
+                         (start, min(start + shardsize - 1, last)))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+def queue_job(conn):
+    """
+    Return a tuple (tool, args) of the queue.
+    """
+    row = conn.execute('SELECT tool, args FROM queue').fetchone()
+    return (row['tool'], json.loads(row['args']))
+
+def claim_shard(conn, owner):
+    """
+    Claim a pending (or abandoned) shard for @owner and return its row,
+    or None if there is none left.
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute("UPDATE shards SET state = 'pending', owner = NULL "
+                     "WHERE state = 'running' AND heartbeat < ? AND attempts < ?",
+                     (now - STALE_TIMEOUT, MAX_ATTEMPTS))
+        conn.execute("UPDATE shards SET state = 'failed' "
+                     "WHERE state = 'running' AND heartbeat < ?",
+                     (now - STALE_TIMEOUT,))
+        shard = conn.execute("SELECT * FROM shards WHERE state = 'pending' "
+                             "ORDER BY id LIMIT 1").fetchone()
+        if shard is not None:
+            conn.execute("UPDATE shards SET state = 'running', owner = ?, heartbeat = ?, "
+                         "attempts = attempts + 1 WHERE id = ?", (owner, now, shard['id']))
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    return shard
+
+def heartbeat(conn, shardid, owner):
+    """
+    Refresh the heartbeat of shard @shardid. Return False if the shard
+    is no longer owned by @owner (it was taken over as abandoned).
+    """
+    cursor = conn.execute("UPDATE shards SET heartbeat = ? "
+                          "WHERE id = ? AND owner = ? AND state = 'running'",
+                          (time.time(), shardid, owner))
+    return cursor.rowcount > 0
+
+def finish_shard(conn, shardid, owner, status):
+    """
+    Mark shard @shardid done, or failed if its exit @status is non-zero.
+    """
+    conn.execute("UPDATE shards SET state = ?, status = ? "
+                 "WHERE id = ? AND owner = ? AND state = 'running'",
+                 ('done' if status == 0 else 'failed', status, shardid, owner))
+
+def shards_running(conn):
+    """
+    Return the number of shards currently being processed.
+    """
+    return conn.execute("SELECT COUNT(*) FROM shards WHERE state = 'running'").fetchone()[0]
+
+def list_shards(conn):
+    """
+    Return rows of all the shards, in order.
+    """
+    return conn.execute('SELECT * FROM shards ORDER BY id').fetchall()
+
+
+def expand_arg(arg, shard, frameNo = None):
+    """
+    Return argument template @arg filled in for @shard (and @frameNo).
+    """
+    arg = (arg.replace('{first}', str(shard['first']))
+              .replace('{last}', str(shard['last']))
+              .replace('{shard}', str(shard['id'])))
+    if frameNo is not None:
+        arg = arg.replace('{frame}', str(frameNo))
+    return arg
+
+def shard_commands(args, shard):
+    """
+    Return a list of argument lists to run the tool with to process
+    @shard, given argument templates @args.
+    """
+    if any('{frame}' in arg for arg in args):
+        return [[expand_arg(arg, shard, frameNo) for arg in args]
+                for frameNo in range(shard['first'], shard['last'] + 1)]
+    return [[expand_arg(arg, shard) for arg in args]]
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#
+# sigextract - a single entry point to all the sigextract tools
+#
+# Usage: sigextract.py TOOL ARGS...
+#        sigextract.py worker [SOCKETPATH]
+#        sigextract.py shard QUEUEFILE create SHARDSIZE FIRST-LAST TOOL ARGS...
+#        sigextract.py shard QUEUEFILE run|status
+#        sigextract.py shard QUEUEFILE merge SHARDOUTPUT OUTPUT
+#
+# TOOL is the name of one of the tool scripts without the .py suffix
+# (pose-extract-lf, straighten, interpose-neuroml, extract-traces,
+# render-overlay, bb-reverse, bb-orient, neuroml-soma-to-json); ARGS
+# are passed to it just as if the script was run directly.
+#
+# In the worker mode, jobs are read as JSON lines from stdin or, if
+# SOCKETPATH is given, from connections to a unix socket bound there.
+# Each job looks like
+#   {"id": 1, "tool": "pose-extract-lf", "args": ["rec.h5", "5"], "output": "5.tsv"}
+# where "id" and "output" are optional. The libraries, tool scripts,
+# opened HDF5 files and loaded neurons stay resident between jobs, so
+# a sequence of many small jobs does not pay the startup cost each time.
+# For each job, a JSON line is written back:
+#   {"id": 1, "status": 0}
+# with the captured stdout of the tool in the "stdout" field if no
+# "output" file was given, and the traceback in the "error" field
+# if the tool failed.
+#
+# The shard mode lets any number of nodes cooperate on a batch run
+# through a work queue QUEUEFILE on shared storage (see shardlib.py).
+# "create" splits frames FIRST to LAST into shards of SHARDSIZE frames,
+# ARGS being templates with {first}, {last}, {shard} or {frame} filled
+# in for each shard, e.g.
+#   sigextract.py shard q.db create 500 0-9999 extract-traces \
+#       -f {first}-{last} rec.h5 bb/%d.tsv 1,5,0 nml traces-{shard}.h5
+# "run" then processes shards until none are left; start it on each
+# node. Each shard is run in a child worker process (as above), fed the
+# shard's commands as jobs, one per frame with {frame}. "status" lists the shards. "merge" combines the per-shard
+# outputs (SHARDOUTPUT template, e.g. traces-{shard}.h5) into OUTPUT,
+# for tools that produce a single output file (extract-traces); tools
+# writing per-frame files (pose-extract-lf -o, straighten, render-overlay
+# with an image sequence) need no merge. pose-extract-lf -b cannot be
+# sharded, as its blob ids are not carried over from one run to another.
+
+from __future__ import print_function
+
+import imp
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import shardlib
+
+
+TOOLDIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS = ['pose-extract-lf', 'straighten', 'interpose-neuroml',
+         'bb-reverse', 'neuroml-soma-to-json', 'extract-traces',
+         'render-overlay', 'bb-orient']
+
+# Loaded tool modules, keyed by tool name
+_tools = {}
+
+
+def load_tool(name):
+    """
+    Return the module of tool script @name, loading it on first use.
+    """
+    if name not in TOOLS:
+        raise ValueError('Unknown tool ' + name)
+    module = _tools.get(name)
+    if module is None:
+        module = imp.load_source(name.replace('-', '_'),
+                                 os.path.join(TOOLDIR, name + '.py'))
+        _tools[name] = module
+    return module
+
+def run_tool(name, argv):
+    """
+    Run main() of tool @name with arguments @argv, returning its exit
+    status.
+    """
+    try:
+        status = load_tool(name).main(argv)
+    except SystemExit as e:
+        status = e.code
+    if status is None:
+        status = 0
+    return status
+
+def run_job(job):
+    """
+    Run a single worker @job (a dict decoded from its JSON line)
+    and return a result dict.
+    """
+    if not isinstance(job, dict):
+        return {'status': 1, 'error': 'Invalid job: not a JSON object'}
+    result = {}
+    if 'id' in job:
+        result['id'] = job['id']
+
+    stdout = sys.stdout
+    out = None
+    try:
+        if job.get('output'):
+            out = open(job['output'], 'w')
+        else:
+            out = StringIO()
+        sys.stdout = out
+        result['status'] = run_tool(job['tool'], [str(a) for a in job.get('args', [])])
+    except Exception:
+        result['status'] = 1
+        result['error'] = traceback.format_exc()
+    finally:
+        sys.stdout = stdout
+        if job.get('output'):
+            if out is not None:
+                out.close()
+        elif out is not None:
+            result['stdout'] = out.getvalue()
+    return result
+
+def serve_stream(infile, outfile):
+    """
+    Process JSON line jobs from @infile, writing results to @outfile.
+    """
+    while True:
+        line = infile.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            result = {'status': 1, 'error': 'Invalid job: ' + str(e)}
+        else:
+            result = run_job(job)
+        outfile.write(json.dumps(result) + '\n')
+        outfile.flush()
+
+def serve_socket(path):
+    """
+    Accept connections on a unix socket at @path, serving jobs from
+    each connection in turn.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    try:
+        while True:
+            (conn, addr) = server.accept()
+            stream = conn.makefile('rw')
+            try:
+                serve_stream(stream, stream)
+            except socket.error as e:
+                print("Connection error: " + str(e), file = sys.stderr)
+            finally:
+                stream.close()
+                conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def run_shard(conn, args, shard, owner):
+    """
+    Run the tool with argument templates @args on @shard in a child
+    worker process, refreshing the shard heartbeat meanwhile. Return the
+    exit status, or None if the shard was taken over by another node.
+    """
+    # All the commands of the shard (one per frame, if the arguments
+    # have {frame}) are fed as jobs to a single worker, so that the
+    # libraries and the tool are loaded only once per shard
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker'],
+                             stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+    lastbeat = time.time()
+    status = 0
+    try:
+        for argv in shardlib.shard_commands(args, shard):
+            child.stdin.write(json.dumps({'tool': argv[0], 'args': argv[1:]}) + '\n')
+            child.stdin.flush()
+            # Each job gets exactly one result line back, so there is
+            # never more than a line pending when select() says so
+            while True:
+                if time.time() - lastbeat >= shardlib.HEARTBEAT_INTERVAL:
+                    lastbeat = time.time()
+                    if not shardlib.heartbeat(conn, shard['id'], owner):
+                        return None
+                if select.select([child.stdout], [], [], 1)[0]:
+                    break
+            line = child.stdout.readline()
+            if not line:
+                print("Worker of shard %d died" % shard['id'], file = sys.stderr)
+                return status or 1
+            result = json.loads(line)
+            sys.stdout.write(result.get('stdout', ''))
+            sys.stdout.flush()
+            if result.get('error'):
+                sys.stderr.write(result['error'])
+            # Carry on with the other frames, but report the failure
+            status = status or result['status']
+    finally:
+        # The worker is idle between jobs, so it may be stopped right
+        # away, and it has to be if the shard was lost mid-job
+        if child.poll() is None:
+            child.terminate()
+        child.wait()
+    return status
+
+def run_shards(path):
+    """
+    Process shards of queue @path until all of them are finished.
+    """
+    conn = shardlib.open_queue(path)
+    (tool, args) = shardlib.queue_job(conn)
+    owner = shardlib.owner_id()
+    while True:
+        shard = shardlib.claim_shard(conn, owner)
+        if shard is None:
+            if not shardlib.shards_running(conn):
+                break
+            # Wait in case a running shard gets abandoned
+            time.sleep(shardlib.HEARTBEAT_INTERVAL)
+            continue
+        print("Shard %d: frames %d-%d" % (shard['id'], shard['first'], shard['last']), file = sys.stderr)
+        status = run_shard(conn, [tool] + args, shard, owner)
+        if status is not None:
+            shardlib.finish_shard(conn, shard['id'], owner, status)
+    conn.close()
+
+def print_shards(path):
+    """
+    Print the state of shards of queue @path; return the number of
+    shards not done.
+    """
+    conn = shardlib.open_queue(path)
+    notdone = 0
+    for shard in shardlib.list_shards(conn):
+        print("%d\t%d-%d\t%s\t%s\t%d\t%s" % (shard['id'], shard['first'], shard['last'], shard['state'],
+              shard['owner'] or '-', shard['attempts'], '-' if shard['status'] is None else shard['status']))
+        if shard['state'] != 'done':
+            notdone += 1
+    conn.close()
+    return notdone
+
+def merge_shards(path, shardoutput, output):
+    """
+    Merge outputs @shardoutput (a template) of all shards of queue @path
+    into @output, using the mergeShards() function of the tool.
+    """
+    conn = shardlib.open_queue(path)
+    (tool, args) = shardlib.queue_job(conn)
+    shards = shardlib.list_shards(conn)
+    conn.close()
+    notdone = [str(shard['id']) for shard in shards if shard['state'] != 'done']
+    if notdone:
+        raise ValueError('Shards not done: ' + ', '.join(notdone))
+    module = load_tool(tool)
+    if not hasattr(module, 'mergeShards'):
+        raise ValueError('Tool %s has no output to merge' % tool)
+    module.mergeShards(output, [shardlib.expand_arg(shardoutput, shard) for shard in shards])
+
+def shard_main(argv):
+    if len(argv) < 2:
+        print("Usage: sigextract.py shard QUEUEFILE create|run|status|merge ...", file = sys.stderr)
+        return 1
+    (path, command) = argv[:2]
+    if command == 'create' and len(argv) >= 5:
+        if argv[4] == 'pose-extract-lf' and ('-b' in argv[5:] or '--blobs' in argv[5:]):
+            # Blob ids are assigned afresh in each run, so they would
+            # not match across the shards
+            print("pose-extract-lf -b cannot be run in shards", file = sys.stderr)
+            return 1
+        (first, last) = [int(f) for f in argv[3].split('-')]
+        shardlib.create_queue(path, argv[4], argv[5:], first, last, int(argv[2]))
+    elif command == 'run':
+        run_shards(path)
+    elif command == 'status':
+        return 1 if print_shards(path) > 0 else 0
+    elif command == 'merge' and len(argv) == 4:
+        merge_shards(path, argv[2], argv[3])
+    else:
+        print("Invalid shard command: " + ' '.join(argv[1:]), file = sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv):
+    if not argv:
+        print("Usage: sigextract.py TOOL ARGS... | worker [SOCKETPATH] | shard QUEUEFILE ...", file = sys.stderr)
+        print("Tools: " + ', '.join(TOOLS), file = sys.stderr)
+        return 1
+
+    if argv[0] == 'worker':
+        if len(argv) >= 2:
+            serve_socket(argv[1])
+        else:
+            serve_stream(sys.stdin, sys.stdout)
+        return 0
+
+    if argv[0] == 'shard':
+        return shard_main(argv[1:])
+
+    return run_tool(argv[0], argv[1:])
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,161 @@
+# Content-addressed store of stage results
+#
+# Results of the processing stages (backbones, restacked frames,
+# projected neurons, traces) are stored under a key hashing everything
+# they were computed from: the stage name, its parameters and the keys
+# of its inputs (e.g. uvcachelib.uvframe_key() of the frame, digest of
+# a backbone file, or the key of an upstream result).  A re-run then
+# computes only results whose inputs or parameters have changed.
+#
+# A result is a dict of numpy arrays, stored as an .npz file.
+#
+# The store directory is taken from $SIGEXTRACT_STORE (by default
+# ~/.cache/sigextract/store); setting it to an empty string disables
+# the store.
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+import numpy
+
+
+STORE_DIR = os.environ.get('SIGEXTRACT_STORE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'sigextract', 'store'))
+
+# Numbers of [hits, misses] per stage in this process; forked worker
+# processes start counting afresh (see _mystats())
+_stats = {}
+_statspid = os.getpid()
+
+
+def result_key(stage, params, inputs):
+    """
+    Return the key of a result of @stage computed with @params
+    (a JSON-serializable dict) from @inputs (a list of input keys).
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps([stage, params, inputs], sort_keys = True).encode('utf-8'))
+    return h.hexdigest()
+
+def file_digest(filename):
+    """
+    Return a hex digest of the contents of file @filename, to be used
+    as an input key.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def text_digest(text):
+    """
+    Return a hex digest of @text (e.g. serialized input data), to be
+    used as an input key.
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _path(key):
+    return os.path.join(STORE_DIR, key[:2], key + '.npz')
+
+def store_get(key):
+    """
+    Return the result stored under @key, or None if there is none.
+    """
+    if not STORE_DIR:
+        return None
+    try:
+        data = numpy.load(_path(key))
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        return dict([(name, data[name]) for name in data.files])
+    finally:
+        data.close()
+
+def store_put(key, result):
+    """
+    Store @result under @key. The file is written under a temporary
+    name first so that concurrent readers never see partial results.
+    """
+    if not STORE_DIR:
+        return
+    path = _path(key)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    (fd, tmpname) = tempfile.mkstemp(prefix = '.' + key, dir = dirname)
+    with os.fdopen(fd, 'wb') as f:
+        numpy.savez(f, **result)
+    os.rename(tmpname, path)
+
+
+def _mystats():
+    global _statspid
+    if _statspid != os.getpid():
+        # Do not count the parent's lookups again in a forked worker
+        _stats.clear()
+        _statspid = os.getpid()
+    return _stats
+
+def record(stage, hit):
+    """
+    Count a @hit (or a miss) of a @stage result lookup.
+    """
+    stats = _mystats().setdefault(stage, [0, 0])
+    stats[0 if hit else 1] += 1
+
+def cached(stage, params, inputs, compute):
+    """
+    Return a tuple (key, result) with the result of @stage for @params
+    and @inputs, calling @compute() to produce (and store) it only
+    if it is not stored yet.
+    """
+    key = result_key(stage, params, inputs)
+    result = store_get(key)
+    record(stage, result is not None)
+    if result is None:
+        result = compute()
+        store_put(key, result)
+    return (key, result)
+
+def take_stats():
+    """
+    Return the lookup counts recorded in this process so far and reset
+    them; used to hand the counts over from worker processes.
+    """
+    stats = dict(_mystats())
+    _stats.clear()
+    return stats
+
+def merge_stats(stats):
+    """
+    Add lookup counts @stats (as returned by take_stats()) to the counts
+    of this process.
+    """
+    for (stage, (hits, misses)) in stats.items():
+        mystats = _mystats().setdefault(stage, [0, 0])
+        mystats[0] += hits
+        mystats[1] += misses
+
+def report(out = None):
+    """
+    Print hit rates of the stages looked up in this process to @out
+    (stderr by default).
+    """
+    if out is None:
+        out = sys.stderr
+    for stage in sorted(_mystats().keys()):
+        (hits, misses) = _stats[stage]
+        print("%s: %d/%d cached (%.0f%%)" % (stage, hits, hits + misses,
+              100. * hits / (hits + misses)), file = out)
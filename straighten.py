@@ -3,16 +3,29 @@
 # straighten - a toy demo script applying backbone information to optical
 # straightening of the source image by slicing and restacking the image
 #
-# Usage: straighten.py HDF5FILE FRAMENUMBER BACKBONEFILE [OUTPUTFILE]
+# Usage: straighten.py [-m MAPFILE] HDF5FILE FRAMENUMBER BACKBONEFILE [OUTPUTFILE]
 #
 # If OUTPUTFILE is not passed, the straightening result is shown on screen.
+#
+# The straightening geometry depends only on the backbone, so it is
+# precomputed as a "sampling map" that can be applied to any number of
+# images sharing the pose (e.g. other views or refocused slices of
+# the frame). If MAPFILE exists and was built from the same BACKBONEFILE
+# (the map records its digest), the map is loaded from it instead of
+# being built; otherwise, the map is built and saved there.
+#
+# Restacked frames are kept in the result store (see storelib.py) and
+# reused while the frame and the backbone (or map) stay the same.
 
+import argparse
 import math
 import random
 
 import numpy
-import hdf5lflib
 import poselib
+import samplelib
+import storelib
+import uvcachelib
 
 import matplotlib.pyplot as plt
 import scipy.interpolate as interp
@@ -20,69 +33,127 @@ import scipy.misc
 
 import os
 import sys
-import tables
 
-def restackBySpline(spoints, uvframe, cpoints, edgedists):
+def buildSamplingMap(spoints, edgedists, imshape):
     """
-    Restack input pixel frame @uvframe by sequence of traced spline
-    points @spoints while using the (@cpoints, @edgedists) data to
-    determine the stopping point.
+    Precompute sampling of images of @imshape for restacking them by
+    sequence of traced spline points @spoints, using @edgedists to
+    determine the stopping point. Return a dict with "imshape", and
+    for each pixel of the restacked frame, "indices" and "weights" of
+    the four (flattened) source pixels it is interpolated from and
+    whether it is "valid", i.e. within the source image.
     """
     # Width of restacked frame is # of traced points
     # Height of restacked frame is the maximum edge distance * 2.
     (height, width) = (int(math.ceil(max(edgedists) * 2)), len(spoints))
-    restackframe = numpy.zeros(shape=(height, width), dtype='short')
     basey = height / 2
 
-    for x in range(width):
-        # coordinates and derivation
-        (c, d) = spoints[x]
-        for y in range(basey-1):
-            # venture perpendicularly from derivation
-            coord = [c[0] - y*d[1], c[1] + y*d[0]]
-            if coord[0] >= 0 and coord[1] >= 0:
-                try:
-                    restackframe[basey - y][x] = int(hdf5lflib.pointInterpolate(uvframe, coord))
-                except IndexError:
-                    pass
-        for y in range(1, basey-1):
-            coord = [c[0] + y*d[1], c[1] - y*d[0]]
-            if coord[0] >= 0 and coord[1] >= 0:
-                try:
-                    restackframe[basey + y][x] = int(hdf5lflib.pointInterpolate(uvframe, coord))
-                except IndexError:
-                    pass
-
-    return restackframe
+    # Each row is taken at some distance from the backbone, venturing
+    # perpendicularly from derivation; the row at basey is the backbone
+    rowdists = numpy.zeros(height)
+    rowused = numpy.zeros(height, dtype = bool)
+    y = numpy.arange(basey-1)
+    rowdists[basey - y] = y
+    rowused[basey - y] = True
+    y = numpy.arange(1, basey-1)
+    rowdists[basey + y] = -y
+    rowused[basey + y] = True
 
-if __name__ == '__main__':
-    filename = sys.argv[1]
-    frameNo = int(sys.argv[2])
-    bbfilename = sys.argv[3]
-    outputfile = None
-    if len(sys.argv) >= 5:
-        outputfile = sys.argv[4]
-
-    h5file = tables.open_file(filename, mode = "r")
-    node = h5file.get_node('/', '/images/' + str(frameNo))
-    ar = h5file.get_node('/', '/autorectification')
-    try:
-        cw = h5file.get_node('/', '/cropwindow')
-    except tables.NoSuchNodeError:
-        cw = None
-    uvframe = hdf5lflib.compute_uvframe(node, ar, cw)
-
-    (points, edgedists) = poselib.bbLoad(bbfilename)
-    (spline, bblength) = poselib.bbToSpline(points)
-    bbpoints = poselib.bbTraceSpline(spline, bblength, uvframe)
-
-    # Draw the backbone
-    #plt.figure()
-    #plt.plot(bbpoints[:,0,1], bbpoints[:,0,0], 'o') # (x, y) order
-    #plt.axis([0,100,100,0])
-    #plt.show()
-
-    restackframe = restackBySpline(bbpoints, uvframe, points, edgedists)
+    # coordinates and derivation
+    c = numpy.array([p[0] for p in spoints], dtype = float)
+    d = numpy.array([p[1] for p in spoints], dtype = float)
+    cy = c[:, 0] - rowdists[:, numpy.newaxis] * d[:, 1]
+    cx = c[:, 1] + rowdists[:, numpy.newaxis] * d[:, 0]
+
+    (indices, weights, valid) = samplelib.bilinearWeights(imshape, numpy.dstack([cy, cx]))
+    valid &= rowused[:, numpy.newaxis]
+    weights[~valid] = 0.
+    indices[~valid] = 0
+
+    return {"imshape": numpy.array(imshape), "indices": indices.astype(numpy.int32),
+            "weights": weights, "valid": valid}
+
+def saveSamplingMap(mapfile, smap):
+    # Passing a file object keeps numpy from appending .npz to the name
+    with open(mapfile, 'wb') as f:
+        numpy.savez(f, **smap)
+
+def loadSamplingMap(mapfile):
+    data = numpy.load(mapfile)
+    return dict([(key, data[key]) for key in data.files])
+
+def applySamplingMap(smap, images):
+    """
+    Restack an image or a (K, height, width) stack of @images by the
+    sampling map @smap, returning a restacked frame or a stack of them.
+    """
+    images = numpy.asarray(images)
+    if tuple(images.shape[-2:]) != tuple(smap["imshape"]):
+        raise ValueError('Sampling map is for images of shape ' + str(tuple(smap["imshape"])))
+    stack = images.reshape((-1, images.shape[-2] * images.shape[-1]))
+
+    # A single gather for all the images
+    values = (stack[:, smap["indices"]] * smap["weights"]).sum(axis = -1)
+    restackframes = numpy.zeros(values.shape, dtype='short')
+    restackframes[:, smap["valid"]] = values[:, smap["valid"]].astype(int)
+    return restackframes.reshape(images.shape[:-2] + restackframes.shape[1:])
+
+def restackBySpline(spoints, uvframe, cpoints, edgedists):
+    """
+    Restack input pixel frame @uvframe by sequence of traced spline
+    points @spoints while using the (@cpoints, @edgedists) data to
+    determine the stopping point.
+    """
+    smap = buildSamplingMap(spoints, edgedists, uvframe.shape)
+    return applySamplingMap(smap, uvframe)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog = 'straighten.py')
+    parser.add_argument('-m', '--map', default = None)
+    parser.add_argument('filename')
+    parser.add_argument('frameNo', type = int)
+    parser.add_argument('bbfilename')
+    parser.add_argument('outputfile', nargs = '?', default = None)
+    args = parser.parse_args(argv)
+    outputfile = args.outputfile
+
+    h5file = uvcachelib.open_h5file(args.filename)
+    uvframe = uvcachelib.load_uvframe(h5file, args.frameNo)
+
+    bbdigest = storelib.file_digest(args.bbfilename)
+
+    def samplingMap():
+        (points, edgedists) = poselib.bbLoad(args.bbfilename)
+        (spline, bblength) = poselib.bbToSpline(points)
+        bbpoints = poselib.bbTraceSpline(spline, bblength, uvframe)
+
+        # Draw the backbone
+        #plt.figure()
+        #plt.plot(bbpoints[:,0,1], bbpoints[:,0,0], 'o') # (x, y) order
+        #plt.axis([0,100,100,0])
+        #plt.show()
+
+        smap = buildSamplingMap(bbpoints, edgedists, uvframe.shape)
+        # Remember the backbone, to tell stale map files apart
+        smap["bbdigest"] = numpy.array(bbdigest)
+        return smap
+
+    smap = None
+    if args.map:
+        if os.path.exists(args.map):
+            smap = loadSamplingMap(args.map)
+            if "bbdigest" not in smap or str(smap["bbdigest"]) != bbdigest:
+                print >>sys.stderr, "%s was built from a different backbone, rebuilding" % args.map
+                smap = None
+        if smap is None:
+            smap = samplingMap()
+            saveSamplingMap(args.map, smap)
+
+    # The map (whether loaded or built) is determined by the backbone
+    restack = lambda: {"restackframe": applySamplingMap(smap if smap is not None else samplingMap(), uvframe)}
+    (key, result) = storelib.cached('restack', {},
+            [uvcachelib.uvframe_key(h5file, args.frameNo), bbdigest], restack)
+    restackframe = result["restackframe"]
 
     if outputfile:
         scipy.misc.imsave(outputfile, restackframe)
@@ -92,3 +163,7 @@ if __name__ == '__main__':
         axes[0].imshow(uvframe, cmap=plt.cm.gray)
         axes[1].imshow(restackframe, cmap=plt.cm.gray)
         plt.show()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+# Tests of samplelib and of its use in pose-extract-lf.py
+#
+# Run with: python -m pytest test_samplelib.py
+
+import imp
+import math
+import os
+
+import numpy
+import pytest
+
+import samplelib
+
+
+# A small image with distinct values, value = 10 * y + x
+IMAGE = numpy.array([[10. * y + x for x in range(5)] for y in range(4)])
+
+
+def test_integer_points():
+    for (y, x) in [(0, 0), (1, 2), (3, 4), (3, 0), (0, 4)]:
+        assert samplelib.bilinearSample(IMAGE, [[y, x]])[0] == IMAGE[y, x]
+        assert samplelib.bilinearPoint(IMAGE, [y, x]) == IMAGE[y, x]
+
+def test_fractional_points():
+    # IMAGE is linear, so bilinear interpolation must be exact
+    coords = numpy.array([[0.5, 0.5], [1.25, 2.75], [2.9, 3.1], [0., 3.5], [2.5, 4.]])
+    expected = 10. * coords[:, 0] + coords[:, 1]
+    assert numpy.allclose(samplelib.bilinearSample(IMAGE, coords), expected)
+
+    # A non-linear image, checked by hand
+    image = numpy.array([[0., 1.], [2., 7.]])
+    assert samplelib.bilinearPoint(image, [0.5, 0.5]) == pytest.approx(2.5)
+    assert samplelib.bilinearPoint(image, [0.25, 0.75]) == pytest.approx(0.75 * 0.75 + 0.25 * (0.25 * 2. + 0.75 * 7.))
+
+def test_weights_sum_to_one():
+    rng = numpy.random.RandomState(0)
+    coords = rng.uniform(0., 3., size = (100, 2))
+    (indices, weights, valid) = samplelib.bilinearWeights(IMAGE.shape, coords)
+    assert valid.all()
+    assert numpy.allclose(weights.sum(axis = -1), 1.)
+    assert (weights >= 0.).all()
+
+def test_out_of_bounds():
+    coords = [[-0.1, 0.], [0., -0.5], [-1., -1.], [3.01, 0.], [0., 4.01], [10., 10.]]
+    assert numpy.isnan(samplelib.bilinearSample(IMAGE, coords)).all()
+    assert (samplelib.bilinearSample(IMAGE, coords, fill = -1.) == -1.).all()
+    for c in coords:
+        assert samplelib.bilinearPoint(IMAGE, c) is None
+    (indices, weights, valid) = samplelib.bilinearWeights(IMAGE.shape, coords)
+    assert not valid.any()
+    assert (weights == 0.).all()
+
+def test_border():
+    # The last row and column are within the image, without wrapping
+    # around to the first ones
+    coords = numpy.array([[3., 4.], [3., 2.5], [1.5, 4.], [0., 0.]])
+    expected = 10. * coords[:, 0] + coords[:, 1]
+    assert numpy.allclose(samplelib.bilinearSample(IMAGE, coords), expected)
+    (indices, weights, valid) = samplelib.bilinearWeights(IMAGE.shape, coords)
+    assert valid.all()
+    assert (indices >= 0).all() and (indices < IMAGE.size).all()
+
+def test_sample_matches_point():
+    rng = numpy.random.RandomState(1)
+    coords = rng.uniform(-1., 5., size = (200, 2))
+    values = samplelib.bilinearSample(IMAGE, coords)
+    for (c, value) in zip(coords, values):
+        point = samplelib.bilinearPoint(IMAGE, c)
+        if point is None:
+            assert numpy.isnan(value)
+        else:
+            assert point == pytest.approx(value)
+
+def test_sample_shape():
+    coords = numpy.zeros((3, 2, 2))
+    assert samplelib.bilinearSample(IMAGE, coords).shape == (3, 2)
+
+
+@pytest.fixture(scope = 'module')
+def poseextract():
+    try:
+        return imp.load_source('pose_extract_lf',
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pose-extract-lf.py'))
+    except (ImportError, SyntaxError) as e:
+        pytest.skip('pose-extract-lf.py cannot be loaded: %s' % e)
+
+def scalarExtendToTip(point0, point1, edgedists):
+    """
+    The cone walk of extendToTip() evaluating one candidate at a time,
+    as it was done before the candidates were batched.
+    """
+    walkDir = numpy.array([point1[0] - point0[0], point1[1] - point0[1]], dtype = 'float')
+    walkDir /= max(numpy.fabs(walkDir))
+    walkDirDim = math.sqrt(walkDir[0]**2 + walkDir[1]**2)
+
+    point = point1
+    dist = samplelib.bilinearPoint(edgedists, point)
+    while dist > 0:
+        if point[0] < 1. or point[1] < 1. or point[0] >= edgedists.shape[0] - 1. or point[1] >= edgedists.shape[1] - 1.:
+            break
+        nextpoint = point + walkDir
+        nextpointset = [nextpoint]
+        if nextpoint[0] == 0:
+            yset = [-walkDirDim, walkDirDim]
+        else:
+            yset = [nextpoint[0]-point[0], 0]
+        if nextpoint[1] == 0:
+            xset = [-walkDirDim, walkDirDim]
+        else:
+            xset = [nextpoint[1]-point[1], 0]
+        nextpointset += [nextpoint + [y,x] for x in xset for y in yset]
+        nextpoints = []
+        for p in nextpointset:
+            p_edgedist = samplelib.bilinearPoint(edgedists, p)
+            if p_edgedist == 0 or p_edgedist is None:
+                return point
+            nextpoints.append((p, p_edgedist))
+        (point, dist) = max(nextpoints, key = lambda x: x[1])
+    return point
+
+def test_extend_to_tip(poseextract):
+    # An elongated blob, a crude worm
+    (yy, xx) = numpy.mgrid[0:40, 0:80]
+    mask = ((yy - 20.) / 8.) ** 2 + ((xx - 40.) / 32.) ** 2 <= 1.
+    (edgedists, edgedirs) = poseextract.computeEdgeDistances(mask)
+
+    walks = [([20, 30], [20, 40]), ([20, 50], [20, 40]), ([18, 35], [21, 45]),
+             ([22, 45], [19, 33]), ([20, 40], [23, 41]), ([15, 40], [20, 40.5])]
+    for (point0, point1) in walks:
+        points = [numpy.array(point0, dtype = float), numpy.array(point1, dtype = float)]
+        tip = poseextract.extendToTip(0, 1, points, edgedists, edgedirs, mask)
+        expected = scalarExtendToTip(points[0], points[1], edgedists)
+        assert numpy.allclose(tip, expected)
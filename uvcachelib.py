@@ -0,0 +1,222 @@
+# Persistent on-disk cache of rectified uvframes
+#
+# Computing a uvframe (hdf5lflib.compute_uvframe) from the raw light-field
+# image is expensive, yet the same frame is typically processed by several
+# tools (pose-extract-lf.py, straighten.py, interpose-neuroml.py), often
+# repeatedly while their parameters are being tuned.  Therefore, we store
+# computed uvframes as .npy files in a cache directory shared by all the
+# tools and memory-map them when they are requested again.
+#
+# Cache entries are keyed by the recording file identity (absolute path,
+# inode, size and mtime), frame number and rectification parameters
+# (contents of the /autorectification and /cropwindow nodes).  The total
+# size of the cache is bounded; least recently used entries are evicted
+# first.
+#
+# The cache directory is taken from $SIGEXTRACT_CACHE (by default
+# ~/.cache/sigextract/uvframes); setting it to an empty string disables
+# the cache.  $SIGEXTRACT_CACHE_SIZE is the size bound in MiB.
+
+import hashlib
+import os
+import tempfile
+
+import numpy
+import tables
+
+import hdf5lflib
+import storelib
+
+
+CACHE_DIR = os.environ.get('SIGEXTRACT_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'sigextract', 'uvframes'))
+CACHE_SIZE = int(os.environ.get('SIGEXTRACT_CACHE_SIZE', 2048)) * 1024 * 1024
+
+# Rectification parameter digests, keyed by file identity
+_rectdigests = {}
+# Open recordings, kept across calls (e.g. by the sigextract.py worker)
+_h5files = {}
+
+
+def file_identity(filename):
+    """
+    Return a tuple identifying the current contents of file @filename.
+    """
+    st = os.stat(filename)
+    # Full-precision mtime, so that rewrites within a second are noticed
+    return (os.path.abspath(filename), st.st_ino, st.st_size, st.st_mtime)
+
+def open_h5file(filename):
+    """
+    Return recording @filename opened read-only. The file stays open
+    and is reused by later calls from the same process, unless it has
+    been modified in the meantime.
+    """
+    identity = file_identity(filename)
+    # Handles must not be shared with forked worker processes
+    key = (os.getpid(), identity[0])
+    entry = _h5files.get(key)
+    if entry is not None and entry[1].isopen:
+        if entry[0] == identity:
+            return entry[1]
+        entry[1].close()
+    h5file = tables.open_file(filename, mode = "r")
+    _h5files[key] = (identity, h5file)
+    return h5file
+
+def list_frames(h5file):
+    """
+    Return a sorted list of frame numbers stored in @h5file.
+    """
+    images = h5file.get_node('/', '/images')
+    return sorted([int(name) for name in images._v_children])
+
+def rectification_nodes(h5file):
+    """
+    Return an (ar, cw) tuple of autorectification and cropwindow nodes
+    of @h5file, as expected by hdf5lflib.compute_uvframe(); @cw is None
+    if the recording has no crop window.
+    """
+    ar = h5file.get_node('/', '/autorectification')
+    try:
+        cw = h5file.get_node('/', '/cropwindow')
+    except tables.NoSuchNodeError:
+        cw = None
+    return (ar, cw)
+
+def _digest_value(h, value):
+    if isinstance(value, numpy.ndarray):
+        h.update(str(value.dtype).encode('ascii'))
+        h.update(numpy.ascontiguousarray(value).tobytes())
+    else:
+        h.update(repr(value).encode('utf-8'))
+
+def _digest_node(h, node):
+    """
+    Feed all attributes and data of @node (and its children) to hash @h.
+    """
+    if node is None:
+        h.update(b'-')
+        return
+    if isinstance(node, tables.Group):
+        nodes = [node] + list(node._f_walknodes())
+    else:
+        nodes = [node]
+    for n in nodes:
+        h.update(n._v_pathname.encode('utf-8'))
+        attrs = n._v_attrs
+        for name in sorted(attrs._f_list('user')):
+            h.update(name.encode('utf-8'))
+            _digest_value(h, attrs[name])
+        if isinstance(n, tables.Leaf):
+            _digest_value(h, numpy.asarray(n.read()))
+
+def rectification_digest(h5file):
+    """
+    Return a hex digest of the rectification parameters of @h5file.
+    """
+    identity = file_identity(h5file.filename)
+    digest = _rectdigests.get(identity)
+    if digest is None:
+        h = hashlib.sha1()
+        for node in rectification_nodes(h5file):
+            _digest_node(h, node)
+        digest = h.hexdigest()
+        _rectdigests[identity] = digest
+    return digest
+
+def uvframe_key(h5file, frameNo):
+    """
+    Return the cache key of uvframe @frameNo of recording @h5file.
+    """
+    h = hashlib.sha1()
+    h.update(repr(file_identity(h5file.filename)).encode('utf-8'))
+    h.update(repr(int(frameNo)).encode('utf-8'))
+    h.update(rectification_digest(h5file).encode('ascii'))
+    return h.hexdigest()
+
+
+def cache_evict(cachedir, maxsize):
+    """
+    Remove least recently used entries from @cachedir until its total
+    size is at most @maxsize bytes.
+    """
+    entries = []
+    for name in os.listdir(cachedir):
+        if not name.endswith('.npy'):
+            continue
+        path = os.path.join(cachedir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Concurrently evicted by another process
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum([e[1] for e in entries])
+    for (mtime, size, path) in sorted(entries):
+        if total <= maxsize:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def cache_store(cachedir, key, uvframe):
+    """
+    Store @uvframe in @cachedir under @key. The file is written under
+    a temporary name first so that concurrent readers never see partial
+    entries.
+    """
+    if not os.path.isdir(cachedir):
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            if not os.path.isdir(cachedir):
+                raise
+    (fd, tmpname) = tempfile.mkstemp(prefix = '.' + key, dir = cachedir)
+    with os.fdopen(fd, 'wb') as f:
+        numpy.save(f, uvframe)
+    os.rename(tmpname, os.path.join(cachedir, key + '.npy'))
+
+def cache_load(cachedir, key):
+    """
+    Return the uvframe stored in @cachedir under @key, or None if it
+    is not cached. The returned array is memory-mapped copy-on-write,
+    i.e. it may be modified in place without affecting the cache entry.
+    """
+    path = os.path.join(cachedir, key + '.npy')
+    try:
+        uvframe = numpy.load(path, mmap_mode = 'c')
+        # Mark as recently used for the LRU eviction
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return numpy.asarray(uvframe)
+
+
+def load_uvframe(h5file, frameNo, cachedir = None):
+    """
+    Return uvframe @frameNo of recording @h5file (an open tables file),
+    computing it by hdf5lflib.compute_uvframe() only if it is not found
+    in the cache @cachedir (by default, CACHE_DIR).
+    """
+    if cachedir is None:
+        cachedir = CACHE_DIR
+
+    if cachedir:
+        key = uvframe_key(h5file, frameNo)
+        uvframe = cache_load(cachedir, key)
+        storelib.record('uvframe', uvframe is not None)
+        if uvframe is not None:
+            return uvframe
+
+    node = h5file.get_node('/', '/images/' + str(frameNo))
+    (ar, cw) = rectification_nodes(h5file)
+    uvframe = hdf5lflib.compute_uvframe(node, ar, cw)
+
+    if cachedir:
+        cache_store(cachedir, key, uvframe)
+        cache_evict(cachedir, CACHE_SIZE)
+    return uvframe